@@ -1,3 +1,6 @@
-from .voc0712 import AnnotationTransform, detection_collate, VOCDetection, VOC_CLASSES, VOCroot
+from .voc0712 import AnnotationTransform, VOCAnnotationStore, detection_collate, VOCDetection, VOC_CLASSES, VOCroot
 from .coco import COCODetection, COCO_CLASSES, COCOroot
 from .data_augment import *
+from .prefetcher import DataPrefetcher
+from .eval_cache import EvalDataset, EvalCache
+from .detection_store import DetectionStore
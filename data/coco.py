@@ -18,9 +18,9 @@ import numpy as np
 import json
 import uuid
 
-from pycocotools.coco import COCO
-from pycocotools.cocoeval import COCOeval
-from pycocotools import mask as COCOmask
+from .pycocotools.coco import COCO
+from .pycocotools.cocoeval import COCOeval
+from .pycocotools import mask as COCOmask
 
 COCOroot = os.path.join('datasets/', 'coco2017/')
 COCO_CLASSES = ( '__background__', # always index 0
@@ -41,6 +41,72 @@ COCO_CLASSES = ( '__background__', # always index 0
     'refrigerator','book','clock','vase','scissors',
     'teddy bear','hair drier','toothbrush')
 
+class COCOAnnotationIndex(object):
+
+    """Columnar index of a COCO annotation file, the annotations of image i
+    being the rows [offsets[i]:offsets[i + 1]] of the annotation columns.
+    It is built once from the json file and saved as an uncompressed .npz,
+    so that the dataset is loaded without parsing json.
+
+    Arguments:
+        arrays (dict): image_ids, widths, heights and offsets per image,
+            category_ids, bboxes ([x, y, w, h]), iscrowd and areas per
+            annotation, cat_ids and cat_names per category
+    """
+
+    FIELDS = ('image_ids', 'widths', 'heights', 'offsets', 'category_ids', 'bboxes', 'iscrowd', 'areas',
+              'cat_ids', 'cat_names')
+
+    def __init__(self, arrays):
+        for field in self.FIELDS:
+            setattr(self, field, arrays[field])
+
+    @classmethod
+    def build(cls, annofile):
+        """Parse a COCO json annotation file, keeping the order of the images and annotations"""
+        with open(annofile, 'r') as f:
+            dataset = json.load(f)
+        images = dataset['images']
+        anns = dataset.get('annotations', [])
+        cats = dataset['categories']
+        image_ids = np.array([img['id'] for img in images], dtype=np.int64)
+        image_to_pos = dict(zip(image_ids.tolist(), range(len(images))))
+        image_pos = np.array([image_to_pos[ann['image_id']] for ann in anns], dtype=np.int64)
+        order = np.argsort(image_pos, kind='stable')  # annotations grouped by image, in file order
+        offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(image_pos, minlength=len(images)))
+        return cls({
+            'image_ids': image_ids,
+            'widths': np.array([img['width'] for img in images], dtype=np.int64),
+            'heights': np.array([img['height'] for img in images], dtype=np.int64),
+            'offsets': offsets,
+            'category_ids': np.array([ann['category_id'] for ann in anns], dtype=np.int64)[order],
+            'bboxes': np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)[order],
+            'iscrowd': np.array([ann.get('iscrowd', 0) for ann in anns], dtype=np.uint8)[order],
+            'areas': np.array([ann['area'] for ann in anns], dtype=np.float64)[order],
+            'cat_ids': np.array([c['id'] for c in cats], dtype=np.int64),
+            'cat_names': np.array([c['name'] for c in cats]),
+            })
+
+    @classmethod
+    def load(cls, cache_file):
+        """Load an index saved with save(), returns None if there is none"""
+        if not os.path.exists(cache_file):
+            return None
+        with np.load(cache_file) as f:
+            return cls({field: f[field] for field in cls.FIELDS})
+
+    def save(self, cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **{field: getattr(self, field) for field in self.FIELDS})
+        os.replace(tmp_file, cache_file)  # atomic, several processes may build it
+
+    def __len__(self):
+        return len(self.image_ids)
+
+
 class COCODetection(data.Dataset):
 
     """VOC Detection Dataset Object
@@ -57,10 +123,13 @@ class COCODetection(data.Dataset):
             (eg: take in caption string, return tensor of word indices)
         dataset_name (string, optional): which dataset to load
             (default: 'VOC2007')
+        check_images (bool, optional): check that the images exist against a
+            single listing of each image folder, otherwise a missing image is
+            only reported when it is read (default: True)
     """
 
     def __init__(self, root, image_sets, preproc=None, target_transform=None,
-                 dataset_name='COCO'):
+                 dataset_name='COCO', check_images=True):
         self.root = root
         self.cache_path = os.path.join(self.root, 'cache')
         self.image_set = image_sets
@@ -75,27 +144,30 @@ class COCODetection(data.Dataset):
             'test-dev2015' : 'test2015',
         }
 
+        self._coco = None
         for (year, image_set) in image_sets:
             coco_name = image_set+year
             data_name = (self._view_map[coco_name]
                         if coco_name in self._view_map
                         else coco_name)
             annofile = self._get_ann_file(coco_name)
-            _COCO = COCO(annofile)
-            self._COCO = _COCO
+            ann_index = self._load_annotation_index(coco_name, annofile)
+            self._annofile = annofile
             self.coco_name = coco_name
-            cats = _COCO.loadCats(_COCO.getCatIds())
-            self._classes = tuple(['__background__'] + [c['name'] for c in cats])
+            self._classes = tuple(['__background__'] + ann_index.cat_names.tolist())
             self.num_classes = len(self._classes)
             self._class_to_ind = dict(zip(self._classes, range(self.num_classes)))
-            self._class_to_coco_cat_id = dict(zip([c['name'] for c in cats], _COCO.getCatIds()))
-            indexes = _COCO.getImgIds()
+            self._class_to_coco_cat_id = dict(zip(ann_index.cat_names.tolist(), ann_index.cat_ids.tolist()))
+            indexes = ann_index.image_ids.tolist()
             self.image_indexes = indexes
-            self.ids.extend([self.image_path_from_index(data_name, index) for index in indexes ])
+            image_paths = [self.image_path_from_index(data_name, index) for index in indexes ]
+            if check_images:
+                self._check_images(data_name, image_paths)
+            self.ids.extend(image_paths)
             if image_set.find('test') != -1:
                 print('test set will not load annotations!')
             else:
-                self.annotations.extend(self._load_coco_annotations(coco_name, indexes,_COCO))
+                self.annotations.extend(self._annotations_from_index(ann_index))
                 if image_set.find('val') != -1:
                     print('val set will not remove non-valid images!')
                 else:
@@ -107,6 +179,18 @@ class COCODetection(data.Dataset):
                     self.ids = ids
                     self.annotations = annotations
 
+    @property
+    def _COCO(self):
+        """COCO api of the last image set, only parsed for the evaluation"""
+        if self._coco is None:
+            self._coco = COCO(self._annofile)
+        return self._coco
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_coco'] = None  # DataLoader workers do not need the COCO api
+        return state
+
     def image_path_from_index(self, name, index):
         """
         Construct an image path from the image's "index" identifier.
@@ -115,76 +199,72 @@ class COCODetection(data.Dataset):
         #   coco2017/train2017/000000119993.jpg
         file_name = (str(index).zfill(12) + '.jpg')
         image_path = os.path.join(self.root, name, file_name)
-        assert os.path.exists(image_path), 'Path does not exist: {}'.format(image_path)
         return image_path
 
 
+    def _check_images(self, name, image_paths):
+        """
+        Check the image paths against one listing of the image folder rather
+        than with a stat per image.
+        """
+        with os.scandir(os.path.join(self.root, name)) as it:
+            files = set(entry.name for entry in it)
+        missing = [path for path in image_paths if os.path.basename(path) not in files]
+        assert len(missing) == 0, '{} images do not exist, e.g. {}'.format(len(missing), missing[0])
+
+
     def _get_ann_file(self, name):
         prefix = 'instances' if name.find('test') == -1 else 'image_info'
         return os.path.join(self.root, 'annotations', prefix + '_' + name + '.json')
 
 
-    def _load_coco_annotations(self, coco_name, indexes, _COCO):
-        cache_file=os.path.join(self.cache_path,coco_name+'_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = pickle.load(fid)
-            print('{} gt roidb loaded from {}'.format(coco_name,cache_file))
-            return roidb
-
-        gt_roidb = [self._annotation_from_index(index, _COCO) for index in indexes]
-        with open(cache_file, 'wb') as fid:
-            pickle.dump(gt_roidb,fid,pickle.HIGHEST_PROTOCOL)
-        print('wrote gt roidb to {}'.format(cache_file))
-        return gt_roidb
+    def _load_annotation_index(self, coco_name, annofile):
+        cache_file = os.path.join(self.cache_path, coco_name + '_index.npz')
+        index = COCOAnnotationIndex.load(cache_file)
+        if index is not None:
+            print('{} annotation index loaded from {}'.format(coco_name, cache_file))
+            return index
+        index = COCOAnnotationIndex.build(annofile)
+        index.save(cache_file)
+        print('wrote annotation index to {}'.format(cache_file))
+        return index
 
 
-    def _annotation_from_index(self, index, _COCO):
+    def _annotations_from_index(self, index):
         """
-        Loads COCO bounding-box instance annotations. Crowd instances are
-        handled by marking their overlaps (with all categories) to -1. This
-        overlap value means that crowd "instances" are excluded from training.
+        Bounding-box instance annotations of every image of a
+        COCOAnnotationIndex, as [x1, y1, x2, y2, label] rows. Invalid and
+        tiny boxes are removed.
         """
-        im_ann = _COCO.loadImgs(index)[0]
-        width = im_ann['width']
-        height = im_ann['height']
+        num_anns = len(index.category_ids)
+        image_of = np.repeat(np.arange(len(index)), np.diff(index.offsets))
+        width = index.widths[image_of]
+        height = index.heights[image_of]
 
-        annIds = _COCO.getAnnIds(imgIds=index, iscrowd=None)
-        objs = _COCO.loadAnns(annIds)
         # Sanitize bboxes -- some are invalid
-        valid_objs = []
-        for obj in objs:
-            x1 = np.max((0, obj['bbox'][0]))
-            y1 = np.max((0, obj['bbox'][1]))
-            x2 = np.min((width - 1, x1 + np.max((0, obj['bbox'][2] - 1))))
-            y2 = np.min((height - 1, y1 + np.max((0, obj['bbox'][3] - 1))))
-            if obj['area'] > 0 and (x2-x1) > 6 and (y2-y1) > 6:
-                obj['clean_bbox'] = [x1, y1, x2, y2]
-                valid_objs.append(obj)
-        objs = valid_objs
-        num_objs = len(objs)
-
-        res = np.zeros((num_objs, 5))
+        bbox = index.bboxes
+        x1 = np.maximum(0, bbox[:, 0])
+        y1 = np.maximum(0, bbox[:, 1])
+        x2 = np.minimum(width - 1, x1 + np.maximum(0, bbox[:, 2] - 1))
+        y2 = np.minimum(height - 1, y1 + np.maximum(0, bbox[:, 3] - 1))
+        valid = (index.areas > 0) & ((x2 - x1) > 6) & ((y2 - y1) > 6)
 
         # Lookup table to map from COCO category ids to our internal class
         # indices
         coco_cat_id_to_class_ind = dict([(self._class_to_coco_cat_id[cls],
                                           self._class_to_ind[cls])
                                          for cls in self._classes[1:]])
+        labels = np.array([coco_cat_id_to_class_ind[c] for c in index.category_ids.tolist()], dtype=np.float64)
 
-        for ix, obj in enumerate(objs):
-            cls = coco_cat_id_to_class_ind[obj['category_id']]
-            res[ix, 0:4] = obj['clean_bbox']
-            res[ix, 4] = cls
-
-        return res
-
+        res = np.stack((x1, y1, x2, y2, labels), axis=1).reshape(num_anns, 5)
+        counts = np.bincount(image_of[valid], minlength=len(index))
+        return np.split(res[valid], np.cumsum(counts)[:-1])
 
 
     def __getitem__(self, index):
         img_id = self.ids[index]
         target = self.annotations[index]
-        img = cv2.imread(img_id, cv2.IMREAD_COLOR)
+        img = self.pull_image(index)
         height, width, _ = img.shape
 
         if self.target_transform is not None:
@@ -214,7 +294,9 @@ class COCODetection(data.Dataset):
             PIL img
         '''
         img_id = self.ids[index]
-        return cv2.imread(img_id, cv2.IMREAD_COLOR)
+        img = cv2.imread(img_id, cv2.IMREAD_COLOR)
+        assert img is not None, 'Path does not exist: {}'.format(img_id)
+        return img
 
 
     def pull_tensor(self, index):
@@ -264,12 +346,12 @@ class COCODetection(data.Dataset):
         print('~~~~ Summary metrics ~~~~')
         coco_eval.summarize()
 
-    def _do_detection_eval(self, res_file, output_dir):
+    def _do_detection_eval(self, res_file, output_dir, workers=0):
         ann_type = 'bbox'
         coco_dt = self._COCO.loadRes(res_file)
         coco_eval = COCOeval(self._COCO, coco_dt)
         coco_eval.params.useSegm = (ann_type == 'segm')
-        coco_eval.evaluate()
+        coco_eval.evaluate(fast=True, workers=workers)
         coco_eval.accumulate()
         self._print_detection_eval_metrics(coco_eval)
         eval_file = os.path.join(output_dir, 'detection_results.pkl')
@@ -277,58 +359,62 @@ class COCODetection(data.Dataset):
             pickle.dump(coco_eval, fid, pickle.HIGHEST_PROTOCOL)
         print('Wrote COCO eval results to: {}'.format(eval_file))
 
-    def _coco_results_one_category(self, boxes, cat_id):
-        results = []
-        for im_ind, index in enumerate(self.image_indexes):
-            dets = boxes[im_ind].astype(np.float)
-            if dets == []:
-                continue
-            scores = dets[:, -1]
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            results.extend(
-              [{'image_id' : index,
-                'category_id' : cat_id,
-                'bbox' : [xs[k], ys[k], ws[k], hs[k]],
-                'score' : scores[k]} for k in range(dets.shape[0])])
+    def _coco_results_array(self, detections):
+        """
+        Detections of a DetectionStore as a [N, 7] array of
+        (image_id, x, y, w, h, score, category_id) rows, grouped by image
+        """
+        num = detections.num_dets
+        coco_cat_ids = np.array([0] + [self._class_to_coco_cat_id[cls] for cls in self._classes[1:]])
+        boxes = detections.boxes[:num].astype(np.float64)
+        results = np.empty((num, 7))
+        results[:, 0] = np.asarray(self.image_indexes)[detections.image_idx[:num]]
+        results[:, 1:3] = boxes[:, :2]
+        results[:, 3:5] = boxes[:, 2:] - boxes[:, :2] + 1
+        results[:, 5] = detections.scores[:num]
+        results[:, 6] = coco_cat_ids[detections.labels[:num]]
         return results
 
-    def _write_coco_results_file(self, all_boxes, res_file):
+    def _write_coco_results_file(self, detections, res_file):
+        results = self._coco_results_array(detections)
+        print('Writing results to {}'.format(res_file))
+        if res_file.endswith('.npy'):
+            np.save(res_file, results)  # loaded by COCO.loadRes without json
+            return
         # [{"image_id": 42,
         #   "category_id": 18,
         #   "bbox": [258.15,41.29,348.26,243.78],
         #   "score": 0.236}, ...]
-        results = []
-        for cls_ind, cls in enumerate(self._classes):
-            if cls == '__background__':
-                continue
-            #print('Collecting {} results ({:d}/{:d})'.format(cls, cls_ind, self.num_classes ))
-            coco_cat_id = self._class_to_coco_cat_id[cls]
-            results.extend(self._coco_results_one_category(all_boxes[cls_ind],
-                                                           coco_cat_id))
-            '''
-            if cls_ind ==30:
-                res_f = res_file+ '_1.json'
-                print('Writing results json to {}'.format(res_f))
-                with open(res_f, 'w') as fid:
-                    json.dump(results, fid)
-                results = []
-            '''
-        #res_f2 = res_file+'_2.json'
-        print('Writing results json to {}'.format(res_file))
-        with open(res_file, 'w') as fid:
-            json.dump(results, fid)
-
-    def evaluate_detections(self, all_boxes):
+        # streamed image by image, as json.dump would write them
+        template = '{{"image_id": {:d}, "category_id": {:d}, "bbox": [{!r}, {!r}, {!r}, {!r}], "score": {!r}}}'
+        offsets = detections.offsets
+        with open(res_file, 'w', buffering=1 << 20) as fid:
+            fid.write('[')
+            for im_ind in range(len(detections)):
+                if offsets[im_ind] == offsets[im_ind + 1]:
+                    continue
+                if offsets[im_ind] > 0:
+                    fid.write(', ')
+                fid.write(', '.join(template.format(int(r[0]), int(r[6]), r[1], r[2], r[3], r[4], r[5])
+                                    for r in results[offsets[im_ind]:offsets[im_ind + 1]].tolist()))
+            fid.write(']')
+
+    def evaluate_detections(self, detections, workers=0, result_format='json'):
+        """
+        detections is a DetectionStore with the detections of every image
+        of the dataset, workers > 1 evaluates the images in that many
+        processes. The results file is written as json, or as a [N, 7]
+        .npy array with result_format='npy'.
+        """
+        if result_format not in ('json', 'npy'):
+            raise ValueError('Unknown result format {}!'.format(result_format))
         output_dir = os.path.join(self.root, 'eval')
         os.makedirs(output_dir, exist_ok=True)
         res_file = os.path.join(output_dir, ('detections_' + self.coco_name + '_results'))
-        res_file += '.json'
-        self._write_coco_results_file(all_boxes, res_file)
+        res_file += '.' + result_format
+        self._write_coco_results_file(detections, res_file)
         # Only do evaluation on non-test sets
         if self.coco_name.find('test') == -1:
-            self._do_detection_eval(res_file, output_dir)
+            self._do_detection_eval(res_file, output_dir, workers)
         # Optionally cleanup results json file
 
@@ -154,10 +154,61 @@ def _mirror(image, boxes):
     return (image, boxes)
 
 
-def preproc_for_test(image, insize, mean):
+def _input_size(insize):
+    """(height, width) of an input size given as an int or (height, width)"""
+    if isinstance(insize, (tuple, list)):
+        return (int(insize[0]), int(insize[1]))
+    return (int(insize), int(insize))
+
+
+def letterbox_geometry(height, width, insize):
+    """Size and position of a height x width image letterboxed into insize
+
+    Return:
+        (new_width, new_height, left, top) of the resized image in the input
+    """
+    (in_h, in_w) = _input_size(insize)
+    scale = min(in_h / height, in_w / width)
+    new_w = min(in_w, max(1, int(round(width * scale))))
+    new_h = min(in_h, max(1, int(round(height * scale))))
+    return (new_w, new_h, (in_w - new_w) // 2, (in_h - new_h) // 2)
+
+
+def letterbox(image, insize, fill, interpolation=cv2.INTER_LINEAR):
+    """Resize image into insize keeping its aspect ratio, the borders are
+    padded with fill. See letterbox_geometry() for the position of the image.
+    """
+    (in_h, in_w) = _input_size(insize)
+    (height, width, depth) = image.shape
+    (new_w, new_h, left, top) = letterbox_geometry(height, width, insize)
+    output = np.empty((in_h, in_w, depth), dtype=image.dtype)
+    output[:, :] = fill
+    output[top:top + new_h, left:left + new_w] = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+    return output
+
+
+def _normalize_boxes(boxes, height, width, insize, use_letterbox):
+    """Pixel boxes of a height x width image to [0, 1] coordinates of the network input"""
+    boxes = boxes.copy()
+    if use_letterbox:
+        (in_h, in_w) = _input_size(insize)
+        (new_w, new_h, left, top) = letterbox_geometry(height, width, insize)
+        boxes[:, 0::2] = (boxes[:, 0::2] * (new_w / width) + left) / in_w
+        boxes[:, 1::2] = (boxes[:, 1::2] * (new_h / height) + top) / in_h
+    else:
+        boxes[:, 0::2] /= width
+        boxes[:, 1::2] /= height
+    return boxes
+
+
+def preproc_for_test(image, insize, mean, use_letterbox=False):
     interp_methods = [cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_NEAREST, cv2.INTER_LANCZOS4]
     interp_method = interp_methods[random.randrange(5)]
-    image = cv2.resize(image, (insize, insize), interpolation=interp_method)
+    if use_letterbox:
+        image = letterbox(image, insize, mean, interpolation=interp_method)
+    else:
+        (in_h, in_w) = _input_size(insize)
+        image = cv2.resize(image, (in_w, in_h), interpolation=interp_method)
     image = image.astype(np.float32)
     image -= mean
     return image.transpose(2, 0, 1)
@@ -165,10 +216,11 @@ def preproc_for_test(image, insize, mean):
 
 class preproc(object):
 
-    def __init__(self, resize, rgb_means=(104, 117, 123)):
+    def __init__(self, resize, rgb_means=(104, 117, 123), letterbox=False):
 
         self.means = rgb_means
         self.resize = resize
+        self.letterbox = letterbox
 
     def __call__(self, image, targets):
 
@@ -176,7 +228,7 @@ class preproc(object):
         labels = targets[:, -1].copy()
         if len(boxes) == 0:
             targets = np.zeros((1, 5))
-            image = preproc_for_test(image, self.resize, self.means)
+            image = preproc_for_test(image, self.resize, self.means, self.letterbox)
             image = np.ascontiguousarray(image, dtype=np.float32)
             targets = np.ascontiguousarray(targets, dtype=np.float32)
             return (torch.from_numpy(image), targets)
@@ -184,10 +236,8 @@ class preproc(object):
         image_o = image.copy()
         targets_o = targets.copy()
         (height_o, width_o, _) = image_o.shape
-        boxes_o = targets_o[:, :-1]
+        boxes_o = _normalize_boxes(targets_o[:, :-1], height_o, width_o, self.resize, self.letterbox)
         labels_o = targets_o[:, -1]
-        boxes_o[:, 0::2] /= width_o
-        boxes_o[:, 1::2] /= height_o
         labels_o = np.expand_dims(labels_o, 1)
         targets_o = np.hstack((boxes_o, labels_o))
 
@@ -197,10 +247,8 @@ class preproc(object):
         (image_t, boxes) = _mirror(image_t, boxes)
 
         (height, width, _) = image_t.shape
-        image_t = preproc_for_test(image_t, self.resize, self.means)
-        boxes = boxes.copy()
-        boxes[:, 0::2] /= width
-        boxes[:, 1::2] /= height
+        image_t = preproc_for_test(image_t, self.resize, self.means, self.letterbox)
+        boxes = _normalize_boxes(boxes, height, width, self.resize, self.letterbox)
         b_w = (boxes[:, 2] - boxes[:, 0]) * 1.
         b_h = (boxes[:, 3] - boxes[:, 1]) * 1.
         mask_b = np.minimum(b_w, b_h) > 0.01
@@ -208,7 +256,7 @@ class preproc(object):
         labels_t = labels[mask_b].copy()
 
         if len(boxes_t) == 0:
-            image = preproc_for_test(image_o, self.resize, self.means)
+            image = preproc_for_test(image_o, self.resize, self.means, self.letterbox)
             image = np.ascontiguousarray(image, dtype=np.float32)
             targets_o = np.ascontiguousarray(targets_o,
                     dtype=np.float32)
@@ -229,10 +277,12 @@ class BaseTransform(object):
     dimension -> tensorize -> color adj
 
     Arguments:
-        resize (int): input dimension to SSD
+        resize (int or (int,int)): input dimension to SSD, or (height, width)
         rgb_means ((int,int,int)): average RGB of the dataset
             (104,117,123)
         swap ((int,int,int)): final order of channels
+        letterbox (bool): keep the aspect ratio of the image and pad it
+            instead of stretching it to the input
     Returns:
         transform (transform) : callable transform to be applied to test/val
         data
@@ -243,18 +293,41 @@ class BaseTransform(object):
         resize,
         rgb_means=(104, 117, 123),
         swap=(2, 0, 1),
+        letterbox=False,
         ):
 
         self.means = rgb_means
         self.resize = resize
         self.swap = swap
+        self.letterbox = letterbox
 
     # assume input is cv2 img for now
 
     def __call__(self, img):
-        img = cv2.resize(np.array(img), (self.resize, self.resize), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+        if self.letterbox:
+            img = letterbox(np.array(img), self.resize, self.means).astype(np.float32)
+        else:
+            (in_h, in_w) = _input_size(self.resize)
+            img = cv2.resize(np.array(img), (in_w, in_h), interpolation=cv2.INTER_LINEAR).astype(np.float32)
         img -= self.means
         img = img.transpose(self.swap)
         img = np.ascontiguousarray(img, dtype=np.float32)
         return torch.from_numpy(img)
 
+    def box_scale(self, width, height):
+        """Map the [0, 1] boxes of the network input back to the width x height
+        image, as boxes * scale - offset clipped to [0, size]
+
+        Return:
+            (scale, offset, size) tensors of [x, y, x, y] factors, size is
+            [width, height, width, height]
+        """
+        size = torch.Tensor([width, height, width, height])
+        if not self.letterbox:
+            return (size, torch.zeros(4), size)
+        (in_h, in_w) = _input_size(self.resize)
+        (new_w, new_h, left, top) = letterbox_geometry(height, width, self.resize)
+        (scale_x, scale_y) = (width / new_w, height / new_h)
+        scale = torch.Tensor([in_w * scale_x, in_h * scale_y, in_w * scale_x, in_h * scale_y])
+        offset = torch.Tensor([left * scale_x, top * scale_y, left * scale_x, top * scale_y])
+        return (scale, offset, size)
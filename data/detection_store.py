@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+
+
+class DetectionStore(object):
+
+    """Detection results of a dataset kept as columns instead of a
+    num_classes x num_images list of small arrays. The rows are grouped by
+    image, the rows of image i being [offsets[i]:offsets[i + 1]], and keep the
+    order in which they were added (by score for the evaluation loop).
+
+    Arguments:
+        num_images (int): number of images of the dataset
+        capacity (int): initial number of rows, the columns grow as needed
+    """
+
+    def __init__(self, num_images, capacity=1 << 16):
+        self.num_images = num_images
+        self.num_dets = 0
+        self.counts = np.zeros(num_images, dtype=np.int64)
+        self.image_idx = np.empty(capacity, dtype=np.int32)
+        self.labels = np.empty(capacity, dtype=np.int32)
+        self.boxes = np.empty((capacity, 4), dtype=np.float32)
+        self.scores = np.empty(capacity, dtype=np.float32)
+        self._last_image = -1
+        self._by_label = None
+
+    def _reserve(self, num):
+        capacity = len(self.scores)
+        if self.num_dets + num <= capacity:
+            return
+        capacity = max(2 * capacity, self.num_dets + num)
+        for name in ('image_idx', 'labels', 'boxes', 'scores'):
+            column = getattr(self, name)
+            grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.num_dets] = column[:self.num_dets]
+            setattr(self, name, grown)
+
+    def add(self, index, dets):
+        """Append the detections of one image, images are added in order
+
+        Arguments:
+            index (int): image index in the dataset
+            dets (ndarray): (xmin, ymin, xmax, ymax, score, class) rows, Shape: [num_dets, 6]
+        """
+        if index < self._last_image:
+            raise ValueError('Images must be added in order, got {} after {}'.format(index, self._last_image))
+        num = len(dets)
+        self._reserve(num)
+        (start, end) = (self.num_dets, self.num_dets + num)
+        self.image_idx[start:end] = index
+        self.boxes[start:end] = dets[:, :4]
+        self.scores[start:end] = dets[:, 4]
+        self.labels[start:end] = dets[:, 5]
+        self.counts[index] += num
+        self.num_dets = end
+        self._last_image = index
+        self._by_label = None
+
+    @property
+    def offsets(self):
+        offsets = np.zeros(self.num_images + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=offsets[1:])
+        return offsets
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, index):
+        """Detections of an image as (xmin, ymin, xmax, ymax, score, class) rows"""
+        offsets = self.offsets
+        rows = slice(offsets[index], offsets[index + 1])
+        return np.hstack((self.boxes[rows], self.scores[rows, np.newaxis], self.labels[rows, np.newaxis]))
+
+    def class_detections(self, label):
+        """Detections of one class, ordered by image as they were added
+
+        Return:
+            (image_idx, boxes, scores) of Shape [num_dets], [num_dets, 4] and [num_dets]
+        """
+        if self._by_label is None:
+            labels = self.labels[:self.num_dets]
+            order = np.argsort(labels, kind='stable')
+            bounds = np.searchsorted(labels[order], np.arange(labels.max() + 2 if self.num_dets > 0 else 1))
+            self._by_label = (order, bounds)
+        (order, bounds) = self._by_label
+        if label + 1 >= len(bounds):
+            rows = order[:0]
+        else:
+            rows = order[bounds[label]:bounds[label + 1]]
+        return (self.image_idx[rows], self.boxes[rows], self.scores[rows])
+
+    def save(self, result_file):
+        """Save all the columns to a single .npz file"""
+        os.makedirs(os.path.dirname(os.path.abspath(result_file)), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(result_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, counts=self.counts, image_idx=self.image_idx[:self.num_dets], labels=self.labels[:self.num_dets],
+                     boxes=self.boxes[:self.num_dets], scores=self.scores[:self.num_dets])
+        os.replace(tmp_file, result_file)
+
+    @classmethod
+    def load(cls, result_file):
+        """Load a store saved with save()"""
+        with np.load(result_file) as f:
+            store = cls(len(f['counts']), capacity=len(f['scores']))
+            store.counts[:] = f['counts']
+            store.num_dets = len(f['scores'])
+            for name in ('image_idx', 'labels', 'boxes', 'scores'):
+                getattr(store, name)[:] = f[name]
+        store._last_image = (int(store.image_idx[store.num_dets - 1]) if store.num_dets > 0 else -1)
+        return store
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import torch
+import torch.utils.data as data
+
+
+class EvalDataset(data.Dataset):
+
+    """Test images preprocessed by transform, for batched evaluation.
+
+    Arguments:
+        dataset (Dataset): VOCDetection or COCODetection test set
+        transform (callable): transformation to the network input, e.g. BaseTransform
+    """
+
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __getitem__(self, index):
+        """Returns the network input and the (scale, offset, size) mapping its boxes back to the image,
+        see BaseTransform.box_scale()"""
+        img = self.dataset.pull_image(index)
+        (height, width) = img.shape[:2]
+        (scale, offset, size) = self.transform.box_scale(width, height)
+        return (self.transform(img), scale, offset, size)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def _image_ids(dataset):
+    """Image ids of dataset as strings, VOC ids are (rootpath, name) tuples"""
+    return np.array([os.path.join(*img_id) if isinstance(img_id, tuple) else str(img_id) for img_id in dataset.ids])
+
+
+def _transform_signature(transform):
+    """Parameters of a BaseTransform that change the cached inputs"""
+    return repr((type(transform).__name__, transform.resize, tuple(transform.means), tuple(transform.swap),
+                 getattr(transform, 'letterbox', False)))
+
+
+class EvalCache(data.Dataset):
+
+    """On-disk cache of the preprocessed evaluation inputs.
+
+    The test images are decoded, resized and mean-subtracted once by the
+    BaseTransform, then stored as a memory-mapped [num_images, 3, height,
+    width] float16 array, so later evaluations skip JPEG decoding and
+    resizing. BaseTransform resizes uint8 images and subtracts integer means,
+    so the float16 values are exact. A metadata file keeps the original
+    (width, height) of every image, the image ids and the transform
+    signature; it is written last, so a cache without it is incomplete, and
+    a cache whose ids or transform differ is rebuilt.
+
+    Arguments:
+        cache_file (string): path prefix of the cache, see cache_name()
+        transform (BaseTransform): transformation the cache was built with
+    """
+
+    def __init__(self, cache_file, transform):
+        self.images = np.load(cache_file + '_images.npy', mmap_mode='r')
+        with np.load(cache_file + '_meta.npz') as f:
+            self.sizes = f['sizes']
+            self.image_ids = f['image_ids']
+            self.signature = str(f['signature'])
+        self.transform = transform
+
+    @staticmethod
+    def cache_name(dataset, size):
+        """Cache path prefix keyed by dataset, split and input size (e.g. 320 or 384x640_letterbox)"""
+        splits = '_'.join(year + name for (year, name) in dataset.image_set)
+        return os.path.join(dataset.root, 'eval_cache', '{}_{}_size{}'.format(type(dataset).__name__, splits, size))
+
+    @classmethod
+    def exists(cls, cache_file):
+        return os.path.exists(cache_file + '_images.npy') and os.path.exists(cache_file + '_meta.npz')
+
+    @classmethod
+    def build(cls, dataset, transform, cache_file):
+        """Preprocess every image of dataset with transform into cache_file"""
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        num_images = len(dataset)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        if os.path.exists(cache_file + '_meta.npz'):
+            os.remove(cache_file + '_meta.npz')  # the cache is invalid until rebuilt
+        images = None
+        sizes = np.zeros((num_images, 2), dtype=np.int32)
+        for i in range(num_images):
+            img = dataset.pull_image(i)
+            x = transform(img).numpy()
+            if images is None:
+                images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float16, shape=(num_images, ) + x.shape)
+            images[i] = x
+            sizes[i] = (img.shape[1], img.shape[0])
+            if i % 1000 == 0:
+                print('Caching {:d}/{:d} evaluation images'.format(i + 1, num_images))
+        images.flush()
+        del images
+        os.replace(tmp_file, cache_file + '_images.npy')
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, sizes=sizes, image_ids=_image_ids(dataset), signature=np.array(_transform_signature(transform)))
+        os.replace(tmp_file, cache_file + '_meta.npz')
+        return cls(cache_file, transform)
+
+    @classmethod
+    def open(cls, dataset, transform, size):
+        """Load the cache of dataset at this input size, build it if needed"""
+        cache_file = cls.cache_name(dataset, size)
+        if cls.exists(cache_file):
+            cache = cls(cache_file, transform)
+            if cache.signature != _transform_signature(transform):
+                print('Evaluation cache {} was built with another transform'.format(cache_file))
+            elif not np.array_equal(cache.image_ids, _image_ids(dataset)):
+                print('Evaluation cache {} was built for other images'.format(cache_file))
+            else:
+                return cache
+            del cache
+        print('Building evaluation cache {}'.format(cache_file))
+        return cls.build(dataset, transform, cache_file)
+
+    def __getitem__(self, index):
+        """Returns the network input and the (scale, offset, size) mapping its boxes back to the image"""
+        x = torch.from_numpy(np.array(self.images[index], dtype=np.float32))
+        (width, height) = self.sizes[index]
+        (scale, offset, size) = self.transform.box_scale(int(width), int(height))
+        return (x, scale, offset, size)
+
+    def __len__(self):
+        return len(self.images)
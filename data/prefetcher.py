@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import torch
+
+
+class DataPrefetcher(object):
+
+    """Iterates over a DataLoader and moves the batches to the device one step
+    ahead, so that the host to device copy of the next batch overlaps with the
+    computation on the current one. On CUDA the copy is issued on a side
+    stream, on other devices the batches are simply moved when fetched.
+
+    Arguments:
+        loader (DataLoader): loader yielding tuples of tensors, use
+            pin_memory=True for the copies to be asynchronous
+        device (torch.device): device to move the batches to
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = (torch.cuda.Stream(device) if device.type == 'cuda' else None)
+        self.batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+        if self.stream is None:
+            self.batch = tuple(t.to(self.device) for t in batch)
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+    def __next__(self):
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            if self.batch is not None:
+                for t in self.batch:
+                    t.record_stream(current_stream)
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        self._preload()
+        return batch
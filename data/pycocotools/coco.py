@@ -313,10 +313,17 @@ class COCO:
 
         print('Loading and preparing results...')
         tic = time.time()
+        if type(resFile) == str and resFile.endswith('.npy'):
+            resFile = np.load(resFile)
+        if type(resFile) == np.ndarray:
+            res.dataset['categories'] = copy.deepcopy(self.dataset['categories'])
+            anns = self.loadNumpyRes(resFile)
+            print('DONE (t={:0.2f}s)'.format(time.time()- tic))
+            res.dataset['annotations'] = anns
+            res.createIndex()
+            return res
         if type(resFile) == str or (PYTHON_VERSION == 2 and type(resFile) == unicode):
             anns = json.load(open(resFile))
-        elif type(resFile) == np.ndarray:
-            anns = self.loadNumpyAnnotations(resFile)
         else:
             anns = resFile
         assert type(anns) == list, 'results in not an array of objects'
@@ -410,6 +417,24 @@ class COCO:
                 }]
         return ann
 
+    def loadNumpyRes(self, data):
+        """
+        Load bbox results from a numpy array [Nx7] where each row contains {imageID,x1,y1,w,h,score,class},
+        the annotations are made from whole columns, without going through loadNumpyAnnotations
+        :param  data (numpy.ndarray)
+        :return: annotations (list) with the fields added by loadRes
+        """
+        assert(type(data) == np.ndarray and data.ndim == 2 and data.shape[1] == 7)
+        imgIds = data[:, 0].astype(np.int64)
+        assert np.isin(imgIds, np.array(self.getImgIds(), dtype=np.int64)).all(), \
+               'Results do not correspond to current coco set'
+        areas = data[:, 3] * data[:, 4]
+        return [{'image_id': imgId, 'bbox': [x, y, w, h], 'score': score, 'category_id': catId,
+                 'area': area, 'id': id + 1, 'iscrowd': 0}
+                for id, (imgId, x, y, w, h, score, catId, area) in enumerate(zip(
+                    imgIds.tolist(), data[:, 1].tolist(), data[:, 2].tolist(), data[:, 3].tolist(), data[:, 4].tolist(),
+                    data[:, 5].tolist(), data[:, 6].astype(np.int64).tolist(), areas.tolist()))]
+
     def annToRLE(self, ann):
         """
         Convert annotation which can be polygons, uncompressed RLE to RLE.
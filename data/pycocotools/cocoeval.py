@@ -6,6 +6,7 @@ import time
 from collections import defaultdict
 from . import mask as maskUtils
 import copy
+import multiprocessing
 
 class COCOeval:
     # Interface for evaluating detection on the Microsoft COCO dataset.
@@ -118,9 +119,11 @@ class COCOeval:
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
-    def evaluate(self):
+    def evaluate(self, fast=False, workers=0):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        :param fast (bool): use evaluateImgFast, same results with all the IoU thresholds matched at once
+        :param workers (int): evaluate shards of the images in that many processes, self.ious is then not kept
         :return: None
         '''
         tic = time.time()
@@ -138,6 +141,21 @@ class COCOeval:
         self.params=p
 
         self._prepare()
+        if workers > 1 and len(p.imgIds) > 1:
+            self.ious = {}
+            self.evalImgs = self._evaluateParallel(fast, workers)
+        else:
+            (self.ious, self.evalImgs) = self._evaluateImgs(fast)
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def _evaluateImgs(self, fast=False):
+        '''
+        Compute the ious and evaluate every image of self.params.imgIds
+        :return: ious dict and evalImgs list, ordered by category, area range and image
+        '''
+        p = self.params
         # loop through images, area range, max detection number
         catIds = p.catIds if p.useCats else [-1]
 
@@ -149,16 +167,68 @@ class COCOeval:
                         for imgId in p.imgIds
                         for catId in catIds}
 
-        evaluateImg = self.evaluateImg
+        evaluateImg = self.evaluateImgFast if fast else self.evaluateImg
         maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
+        evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
                  for catId in catIds
                  for areaRng in p.areaRng
                  for imgId in p.imgIds
              ]
-        self._paramsEval = copy.deepcopy(self.params)
-        toc = time.time()
-        print('DONE (t={:0.2f}s).'.format(toc-tic))
+        return self.ious, evalImgs
+
+    def _evaluateParallel(self, fast, workers):
+        '''
+        Evaluate contiguous shards of the images in a pool of processes, each
+        one gets the gts and dts of its shard only and returns compact
+        arrays, merged here in the order of _evaluateImgs
+        :return: evalImgs list
+        '''
+        p = self.params
+        numShards = min(4 * workers, len(p.imgIds))
+        bounds = np.linspace(0, len(p.imgIds), numShards + 1).astype(int)
+        shardOf = {}
+        for s in range(numShards):
+            for imgId in p.imgIds[bounds[s]:bounds[s+1]]:
+                shardOf[imgId] = s
+        gts = [{} for _ in range(numShards)]
+        dts = [{} for _ in range(numShards)]
+        for (shards, anns) in ((gts, self._gts), (dts, self._dts)):
+            for key, value in anns.items():
+                if key[0] in shardOf:
+                    shards[shardOf[key[0]]][key] = value
+        shardParams = []
+        for s in range(numShards):
+            sp = copy.copy(p)
+            sp.imgIds = p.imgIds[bounds[s]:bounds[s+1]]
+            shardParams.append(sp)
+
+        catIds = p.catIds if p.useCats else [-1]
+        (K, A, I) = (len(catIds), len(p.areaRng), len(p.imgIds))
+        evalImgs = [None] * (K * A * I)
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap(_evaluateShard, [(shardParams[s], gts[s], dts[s], fast) for s in range(numShards)])
+            for s, result in enumerate(results):
+                (start, num) = (bounds[s], bounds[s+1] - bounds[s])
+                for k, catId in enumerate(catIds):
+                    for a, aRng in enumerate(p.areaRng):
+                        for i, e in enumerate(result[(k * A + a) * num:(k * A + a + 1) * num]):
+                            if e is None:
+                                continue
+                            (dtIds, gtIds, dtm, gtm, dtScores, gtIg, dtIg) = e
+                            evalImgs[(k * A + a) * I + start + i] = {
+                                'image_id':     p.imgIds[start + i],
+                                'category_id':  catId,
+                                'aRng':         aRng,
+                                'maxDet':       p.maxDets[-1],
+                                'dtIds':        dtIds,
+                                'gtIds':        gtIds,
+                                'dtMatches':    dtm,
+                                'gtMatches':    gtm,
+                                'dtScores':     dtScores,
+                                'gtIgnore':     gtIg,
+                                'dtIgnore':     dtIg,
+                            }
+        return evalImgs
 
     def computeIoU(self, imgId, catId):
         p = self.params
@@ -312,6 +382,82 @@ class COCOeval:
                 'dtIgnore':     dtIg,
             }
 
+    def evaluateImgFast(self, imgId, catId, aRng, maxDet):
+        '''
+        perform evaluation for single category and image, same results as
+        evaluateImg but the detections are matched at all the IoU thresholds
+        at once, as [TxG] arrays
+        :return: dict (single image results)
+        '''
+        p = self.params
+        if p.useCats:
+            gt = self._gts[imgId,catId]
+            dt = self._dts[imgId,catId]
+        else:
+            gt = [_ for cId in p.catIds for _ in self._gts[imgId,cId]]
+            dt = [_ for cId in p.catIds for _ in self._dts[imgId,cId]]
+        if len(gt) == 0 and len(dt) ==0:
+            return None
+
+        gtIg = np.array([1 if (g['ignore'] or (g['area']<aRng[0] or g['area']>aRng[1])) else 0 for g in gt])
+
+        # sort dt highest score first, sort gt ignore last
+        gtind = np.argsort(gtIg, kind='mergesort')
+        gtIg = gtIg[gtind]
+        gt = [gt[i] for i in gtind]
+        dtind = np.argsort([-d['score'] for d in dt], kind='mergesort')
+        dt = [dt[i] for i in dtind[0:maxDet]]
+        iscrowd = np.array([int(o['iscrowd']) for o in gt], dtype=bool)
+        # load computed ious
+        ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId]
+
+        T = len(p.iouThrs)
+        G = len(gt)
+        D = len(dt)
+        gtm  = np.zeros((T,G))
+        dtm  = np.zeros((T,D))
+        dtIg = np.zeros((T,D))
+        if not len(ious)==0:
+            # gt in reverse order so that argmax returns the last best gt as in
+            # evaluateImg, regular gt ranked above any ignored gt
+            thrs = np.minimum(p.iouThrs, 1-1e-10)
+            rev = slice(None, None, -1)
+            (iousRev, gtIgRev, crowdRev) = (ious[:, rev], gtIg[rev], iscrowd[rev])
+            gtIdsRev = np.array([g['id'] for g in gt])[rev]
+            # [DxTxG] overlapping enough at each IoU, and > 0 ranks of the matches
+            over = iousRev[:, np.newaxis, :] >= thrs[np.newaxis, :, np.newaxis]
+            rank = iousRev + 1 + 2 * (gtIgRev == 0)
+            free = np.ones((T,G), dtype=bool)   # gt not matched yet, or crowd
+            tind = np.arange(T)
+            for dind in np.where(over.any(axis=(1, 2)))[0].tolist():
+                score = (over[dind] & free) * rank[dind]
+                m = score.argmax(axis=1)
+                matched = score[tind, m] > 0
+                if not matched.any():
+                    continue
+                (t, g) = (tind[matched], m[matched])
+                dtIg[t,dind] = gtIgRev[g]
+                dtm[t,dind]  = gtIdsRev[g]
+                gtm[t,G-1-g] = dt[dind]['id']
+                free[t,g]    = crowdRev[g]
+        # set unmatched detections outside of area range to ignore
+        a = np.array([d['area']<aRng[0] or d['area']>aRng[1] for d in dt]).reshape((1, len(dt)))
+        dtIg = np.logical_or(dtIg, np.logical_and(dtm==0, np.repeat(a,T,0)))
+        # store results for given image and category
+        return {
+                'image_id':     imgId,
+                'category_id':  catId,
+                'aRng':         aRng,
+                'maxDet':       maxDet,
+                'dtIds':        [d['id'] for d in dt],
+                'gtIds':        [g['id'] for g in gt],
+                'dtMatches':    dtm,
+                'gtMatches':    gtm,
+                'dtScores':     [d['score'] for d in dt],
+                'gtIgnore':     gtIg,
+                'dtIgnore':     dtIg,
+            }
+
     def accumulate(self, p = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
@@ -375,8 +521,8 @@ class COCOeval:
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
                     for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
                         tp = np.array(tp)
                         fp = np.array(fp)
@@ -495,6 +641,22 @@ class COCOeval:
     def __str__(self):
         self.summarize()
 
+def _evaluateShard(args):
+    '''
+    Evaluate one shard of images in a worker process of COCOeval._evaluateParallel
+    :return: list of None or (dtIds, gtIds, dtMatches, gtMatches, dtScores, gtIgnore, dtIgnore) tuples
+    '''
+    (params, gts, dts, fast) = args
+    E = COCOeval(iouType=params.iouType)
+    E.params = params
+    E._gts = defaultdict(list, gts)
+    E._dts = defaultdict(list, dts)
+    (_, evalImgs) = E._evaluateImgs(fast)
+    return [None if e is None else
+            (np.array(e['dtIds']), np.array(e['gtIds']), e['dtMatches'], e['gtMatches'],
+             np.array(e['dtScores']), e['gtIgnore'], e['dtIgnore'])
+            for e in evalImgs]
+
 class Params:
     '''
     Params for coco evaluation api
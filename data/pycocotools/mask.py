@@ -1,6 +1,6 @@
 __author__ = 'tsungyi'
 
-import pycocotools._mask as _mask
+import numpy as np
 
 # Interface for manipulating masks stored in RLE format.
 #
@@ -65,6 +65,8 @@ import pycocotools._mask as _mask
 #  iou(gt,dt,iscrowd) = iou(gt',dt) = area(intersect(gt,dt)) / area(dt)
 # For crowd gt regions we use this modified criteria above for the iou.
 #
+# Bounding box ious are computed in NumPy by bbIou, the compiled _mask
+# extension is only imported for the RLE functions.
 # To compile run "python setup.py build_ext --inplace"
 # Please do not contact us for help with compiling.
 #
@@ -73,11 +75,53 @@ import pycocotools._mask as _mask
 # Code written by Piotr Dollar and Tsung-Yi Lin, 2015.
 # Licensed under the Simplified BSD License [see coco/license.txt]
 
-iou         = _mask.iou
-merge       = _mask.merge
-frPyObjects = _mask.frPyObjects
+_mask = None
+
+def _maskApi():
+    global _mask
+    if _mask is None:
+        import pycocotools._mask as _mask
+    return _mask
+
+def _isBoxes(objs):
+    if type(objs) == np.ndarray:
+        return objs.size == 0 or objs.shape[-1] == 4
+    return type(objs) == list and all((type(obj) == list or type(obj) == np.ndarray) and len(obj) == 4 for obj in objs)
+
+def bbIou(dt, gt, iscrowd):
+    """
+    NumPy version of iou() for [x y w h] bounding boxes, same results as
+    the compiled one. Leading dimensions are broadcast, so padded boxes of
+    many images are computed at once: dt [...xmx4], gt [...xnx4], iscrowd
+    [...xn] give [...xmxn] ious.
+    """
+    dt = np.asarray(dt, dtype=np.double)
+    gt = np.asarray(gt, dtype=np.double)
+    if dt.size == 0 or gt.size == 0:
+        return []
+    crowd = np.asarray(iscrowd, dtype=bool)[..., np.newaxis, :]
+    (D, G) = (dt[..., :, np.newaxis, :], gt[..., np.newaxis, :, :])
+    w = np.minimum(D[..., 2] + D[..., 0], G[..., 2] + G[..., 0]) - np.maximum(D[..., 0], G[..., 0])
+    h = np.minimum(D[..., 3] + D[..., 1], G[..., 3] + G[..., 1]) - np.maximum(D[..., 1], G[..., 1])
+    i = w * h
+    da = D[..., 2] * D[..., 3]
+    u = np.where(crowd, da, da + G[..., 2] * G[..., 3] - i)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((w > 0) & (h > 0), i / u, 0.)
+
+def iou(dt, gt, iscrowd):
+    if _isBoxes(dt) and _isBoxes(gt):
+        return bbIou(dt, gt, iscrowd)
+    return _maskApi().iou(dt, gt, iscrowd)
+
+def merge(rleObjs, intersect=0):
+    return _maskApi().merge(rleObjs, intersect)
+
+def frPyObjects(pyobj, h, w):
+    return _maskApi().frPyObjects(pyobj, h, w)
 
 def encode(bimask):
+    _mask = _maskApi()
     if len(bimask.shape) == 3:
         return _mask.encode(bimask)
     elif len(bimask.shape) == 2:
@@ -85,19 +129,22 @@ def encode(bimask):
         return _mask.encode(bimask.reshape((h, w, 1), order='F'))[0]
 
 def decode(rleObjs):
+    _mask = _maskApi()
     if type(rleObjs) == list:
         return _mask.decode(rleObjs)
     else:
         return _mask.decode([rleObjs])[:,:,0]
 
 def area(rleObjs):
+    _mask = _maskApi()
     if type(rleObjs) == list:
         return _mask.area(rleObjs)
     else:
         return _mask.area([rleObjs])[0]
 
 def toBbox(rleObjs):
+    _mask = _maskApi()
     if type(rleObjs) == list:
         return _mask.toBbox(rleObjs)
     else:
-        return _mask.toBbox([rleObjs])[0]
\ No newline at end of file
+        return _mask.toBbox([rleObjs])[0]
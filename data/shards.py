@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Packed image shards.
+
+The encoded JPEG bytes of a dataset are concatenated into a few large shard
+files, read back through mmap and decoded from memory, so that training does
+not pay the per-file open latency of network filesystems. A shard directory
+contains:
+
+    meta.json                   source dataset and number of images/shards
+    shard_00000.bin, ...        concatenated JPEG bytes
+    index.npy                   [num_images, 3] (shard, offset, length)
+    annotations_boxes.npy       VOCAnnotationStore of the targets
+    annotations_offsets.npy
+
+Convert a training set with:
+
+    python3 -m data.shards --dataset VOC --out datasets/VOC0712trainval_shards
+"""
+
+import os
+import json
+import math
+import argparse
+import cv2
+import numpy as np
+import torch
+import torch.utils.data as data
+from .voc0712 import VOCAnnotationStore
+
+
+def _image_file(dataset, index):
+    img_id = dataset.ids[index]
+    if isinstance(img_id, tuple):  # VOC ids are (rootpath, name)
+        return dataset._imgpath % img_id
+    return img_id
+
+
+def _target(dataset, index):
+    if dataset.annotations is None:  # VOC without annotation store
+        import xml.etree.ElementTree as ET
+        target = ET.parse(dataset._annopath % dataset.ids[index]).getroot()
+        return dataset.target_transform(target)
+    return dataset.annotations[index]
+
+
+def write_shards(dataset, source, out_dir, shard_size=1 << 30):
+    """Pack the images and targets of a VOCDetection or COCODetection
+    training set into shard files of about shard_size bytes each.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    num_images = len(dataset)
+    index = np.zeros((num_images, 3), dtype=np.int64)
+    annos = []
+    (shard, offset, f) = (0, 0, None)
+    for i in range(num_images):
+        if f is None or offset >= shard_size:
+            if f is not None:
+                f.close()
+                shard += 1
+            f = open(os.path.join(out_dir, 'shard_{:05d}.bin'.format(shard)), 'wb')
+            offset = 0
+        with open(_image_file(dataset, i), 'rb') as img_f:
+            buf = img_f.read()
+        f.write(buf)
+        index[i] = (shard, offset, len(buf))
+        offset += len(buf)
+        annos.append(np.asarray(_target(dataset, i), dtype=np.float32).reshape(-1, 5))
+        if i % 1000 == 0:
+            print('Packed {:d}/{:d} images'.format(i + 1, num_images))
+    if f is not None:
+        f.close()
+
+    offsets = np.zeros(num_images + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(anno) for anno in annos])
+    boxes = (np.concatenate(annos) if len(annos) > 0 else np.empty((0, 5), dtype=np.float32))
+    VOCAnnotationStore(boxes, offsets).save(os.path.join(out_dir, 'annotations'))
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    meta = {
+        'dataset': source,
+        'name': dataset.name,
+        'num_images': num_images,
+        'num_shards': (shard + 1 if num_images > 0 else 0),
+        }
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    print('Wrote {:d} images in {:d} shards to {}'.format(num_images, meta['num_shards'], out_dir))
+
+
+class ShardDetection(data.Dataset):
+
+    """Detection Dataset Object reading the shards written by write_shards
+
+    input is image, target is annotation
+
+    Arguments:
+        root (string): filepath to the shard directory
+        preproc (callable, optional): transformation to perform on the
+            input image and its target
+    """
+
+    def __init__(self, root, preproc=None):
+        self.root = root
+        self.preproc = preproc
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.source = self.meta['dataset']
+        self.name = self.meta['name']
+        self.index = np.load(os.path.join(root, 'index.npy'), mmap_mode='r')
+        self.annotations = VOCAnnotationStore.load(os.path.join(root, 'annotations'))
+        self._shards = dict()  # opened lazily, after the DataLoader workers are forked
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            path = os.path.join(self.root, 'shard_{:05d}.bin'.format(shard))
+            self._shards[shard] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self._shards[shard]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = dict()
+        return state
+
+    def shard_of(self, index):
+        return int(self.index[index, 0])
+
+    def pull_image(self, index):
+        (shard, offset, length) = self.index[index]
+        buf = self._shard(int(shard))[offset:offset + length]
+        return cv2.imdecode(np.asarray(buf), cv2.IMREAD_COLOR)
+
+    def __getitem__(self, index):
+        img = self.pull_image(index)
+        target = self.annotations[index]
+
+        if self.preproc is not None:
+            img, target = self.preproc(img, target)
+
+        return img, target
+
+    def __len__(self):
+        return len(self.index)
+
+
+class ShardSampler(data.Sampler):
+
+    """Shard-aware shuffling: the order of the shards and the order of the
+    images inside each shard are shuffled, but the images of one shard are
+    visited together so that reads stay mostly sequential. With several
+    processes, each one gets a contiguous part of the permutation.
+
+    Arguments:
+        dataset (ShardDetection): dataset to sample from
+        shuffle (bool): shuffle the shards and their images
+        num_replicas (int): number of processes in distributed training
+        rank (int): rank of the current process
+        seed (int): random seed shared by all processes
+    """
+
+    def __init__(self, dataset, shuffle=True, num_replicas=1, rank=0, seed=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(dataset) / num_replicas))
+        shards = np.asarray(dataset.index[:, 0])
+        self.shard_ids = np.unique(shards)
+        self.shard_images = [np.nonzero(shards == s)[0] for s in self.shard_ids]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        order = (torch.randperm(len(self.shard_images), generator=g).tolist() if self.shuffle else range(len(self.shard_images)))
+        indices = []
+        for s in order:
+            images = self.shard_images[s]
+            if self.shuffle:
+                images = images[torch.randperm(len(images), generator=g).numpy()]
+            indices.extend(images.tolist())
+
+        # pad to be evenly divisible, then take a contiguous part
+        total_size = self.num_samples * self.num_replicas
+        indices += indices[:(total_size - len(indices))]
+        return iter(indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples])
+
+    def __len__(self):
+        return self.num_samples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a detection training set into shards')
+    parser.add_argument('--dataset', default='VOC')
+    parser.add_argument('--out', required=True, help='Output shard directory')
+    parser.add_argument('--shard_size', default=1024, type=int, help='Shard size in MB')
+    args = parser.parse_args()
+
+    if args.dataset == 'VOC':
+        from .voc0712 import VOCroot, VOCDetection, AnnotationTransform
+        dataset = VOCDetection(VOCroot, [('2007', 'trainval'), ('2012', 'trainval')], None, AnnotationTransform(), dataset_name='VOC0712trainval')
+    elif args.dataset == 'COCO':
+        from .coco import COCOroot, COCODetection
+        dataset = COCODetection(COCOroot, [('2017', 'train')], None)
+    else:
+        raise NotImplementedError('Unkown dataset {}!'.format(args.dataset))
+    write_shards(dataset, args.dataset, args.out, shard_size=args.shard_size << 20)
@@ -8,7 +8,7 @@ import torchvision.transforms as transforms
 from PIL import Image, ImageDraw, ImageFont
 import cv2
 import numpy as np
-from .voc_eval import voc_eval
+from .voc_eval import load_recs, class_gt, voc_eval_arrays
 import xml.etree.ElementTree as ET
 
 
@@ -48,7 +48,7 @@ class AnnotationTransform(object):
         Returns:
             a list containing lists of bounding boxes  [bbox coords, class name]
         """
-        res = np.empty((0,5))
+        res = []
         for obj in target.iter('object'):
             difficult = int(obj.find('difficult').text) == 1
             if not self.keep_difficult and difficult:
@@ -63,9 +63,61 @@ class AnnotationTransform(object):
                 bndbox.append(cur_pt)
             label_idx = self.class_to_ind[name]
             bndbox.append(label_idx)
-            res = np.vstack((res,bndbox))  # [xmin, ymin, xmax, ymax, label_ind]
+            res.append(bndbox)  # [xmin, ymin, xmax, ymax, label_ind]
 
-        return res  # [[xmin, ymin, xmax, ymax, label_ind], ... ]
+        return np.array(res, dtype=np.float64).reshape(-1, 5)  # [[xmin, ymin, xmax, ymax, label_ind], ... ]
+
+
+class VOCAnnotationStore(object):
+
+    """Pre-parsed annotations of a list of VOC images.
+
+    All the objects are kept in one flat float32 array of
+    [xmin, ymin, xmax, ymax, label_ind] rows, the rows of image i being
+    boxes[offsets[i]:offsets[i + 1]]. Both arrays are saved as .npy files and
+    memory-mapped when loaded, so the XML files are parsed only once and the
+    DataLoader workers share the same pages.
+
+    Arguments:
+        boxes (ndarray): annotations of all the images, Shape: [num_obj, 5]
+        offsets (ndarray): first row of each image, Shape: [num_images + 1]
+    """
+
+    def __init__(self, boxes, offsets):
+        self.boxes = boxes
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, annopath, ids, target_transform):
+        """Parse the XML annotation of every image id with target_transform"""
+        annos = [target_transform(ET.parse(annopath % img_id).getroot()) for img_id in ids]
+        offsets = np.zeros(len(annos) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(anno) for anno in annos])
+        boxes = (np.concatenate(annos).astype(np.float32) if len(annos) > 0 else np.empty((0, 5), dtype=np.float32))
+        return cls(boxes.reshape(-1, 5), offsets)
+
+    @classmethod
+    def load(cls, cache_file):
+        """Memory-map a store saved with save(), returns None if there is none"""
+        if not os.path.exists(cache_file + '_boxes.npy') or not os.path.exists(cache_file + '_offsets.npy'):
+            return None
+        boxes = np.load(cache_file + '_boxes.npy', mmap_mode='r')
+        offsets = np.load(cache_file + '_offsets.npy', mmap_mode='r')
+        return cls(boxes, offsets)
+
+    def save(self, cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        for (suffix, array) in (('_boxes.npy', self.boxes), ('_offsets.npy', self.offsets)):
+            tmp_file = '{}{}.{}.tmp'.format(cache_file, suffix, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_file, cache_file + suffix)  # atomic, several processes may build it
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return np.array(self.boxes[self.offsets[index]:self.offsets[index + 1]])
 
 
 class VOCDetection(data.Dataset):
@@ -84,10 +136,14 @@ class VOCDetection(data.Dataset):
             (eg: take in caption string, return tensor of word indices)
         dataset_name (string, optional): which dataset to load
             (default: 'VOC2007')
+        use_cache (bool, optional): parse the annotations once with
+            target_transform into a VOCAnnotationStore saved in
+            annotations_cache/ instead of parsing the XML at every access
+            (default: True)
     """
 
     def __init__(self, root, image_sets, preproc=None, target_transform=None,
-                 dataset_name='VOC0712'):
+                 dataset_name='VOC0712', use_cache=True):
         self.root = root
         self.image_set = image_sets
         self.preproc = preproc
@@ -101,15 +157,35 @@ class VOCDetection(data.Dataset):
             rootpath = os.path.join(self.root, 'VOC' + year)
             for line in open(os.path.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
                 self.ids.append((rootpath, line.strip()))
+        self.annotations = None
+        if use_cache and self.target_transform is not None:
+            self.annotations = self._load_annotation_store()
+
+    def _load_annotation_store(self):
+        keep_difficult = getattr(self.target_transform, 'keep_difficult', True)
+        cache_file = os.path.join(self.root, 'annotations_cache', '{}{}'.format(
+            '_'.join('VOC' + year + name for (year, name) in self.image_set),
+            ('' if keep_difficult else '_nodifficult'),
+            ))
+        store = VOCAnnotationStore.load(cache_file)
+        if store is not None and len(store) == len(self.ids):
+            return store
+        print('Parsing {} annotations to {}'.format(len(self.ids), cache_file))
+        store = VOCAnnotationStore.build(self._annopath, self.ids, self.target_transform)
+        store.save(cache_file)
+        return VOCAnnotationStore.load(cache_file)
 
     def __getitem__(self, index):
         img_id = self.ids[index]
-        target = ET.parse(self._annopath % img_id).getroot()
         img = cv2.imread(self._imgpath % img_id, cv2.IMREAD_COLOR)
         height, width, _ = img.shape
 
-        if self.target_transform is not None:
-            target = self.target_transform(target)
+        if self.annotations is not None:
+            target = self.annotations[index]
+        else:
+            target = ET.parse(self._annopath % img_id).getroot()
+            if self.target_transform is not None:
+                target = self.target_transform(target)
 
 
         if self.preproc is not None:
@@ -166,22 +242,20 @@ class VOCDetection(data.Dataset):
         to_tensor = transforms.ToTensor()
         return torch.Tensor(self.pull_image(index)).unsqueeze_(0)
 
-    def evaluate_detections(self, all_boxes):
+    def evaluate_detections(self, detections, write_results=False):
         """
-        all_boxes is a list of length number-of-classes.
-        Each list element is a list of length number-of-images.
-        Each of those list elements is either an empty list []
-        or a numpy array of detection.
-
-        all_boxes[class][image] = [] or np.array of shape #dets x 5
+        detections is a DetectionStore with the detections of every image
+        of the dataset, in the order of self.ids. They are evaluated in
+        memory, the comp4_det_test_*.txt files of the devkit are only
+        written with write_results.
         """
         output_dir = os.path.join(self.root, 'eval')
         os.makedirs(output_dir, exist_ok=True)
-        self._write_voc_results_file(all_boxes)
-        results = []
-        for thresh in np.arange(0.5,1,0.05):
-            result = self._do_python_eval(output_dir, thresh)
-            results.append(result)
+        if write_results:
+            self._write_voc_results_file(detections)
+        thresholds = np.arange(0.5,1,0.05)
+        results = list(self._do_python_eval(detections, output_dir, thresholds))
+        for (thresh, result) in zip(thresholds, results):
             print('----thresh={:.2f}, AP={:.3f}'.format(thresh, result))
 
         print('mAP results: AP50={:.3f}, AP75={:.3f}, AP={:.3f}'.format(results[0], results[5], sum(results)/10))
@@ -196,42 +270,32 @@ class VOCDetection(data.Dataset):
         path = os.path.join(filedir, filename)
         return path
 
-    def _write_voc_results_file(self, all_boxes):
+    def _write_voc_results_file(self, detections):
         for cls_ind, cls in enumerate(VOC_CLASSES):
-            cls_ind = cls_ind 
             if cls == '__background__':
                 continue
             #print('Writing {} VOC results file'.format(cls))
             filename = self._get_voc_results_file_template().format(cls)
+            (image_idx, boxes, scores) = detections.class_detections(cls_ind)
             with open(filename, 'wt') as f:
-                for im_ind, index in enumerate(self.ids):
-                    index = index[1]
-                    dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
-                        continue
-                    for k in range(dets.shape[0]):
-                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                                format(index, dets[k, -1],
-                                dets[k, 0] + 1, dets[k, 1] + 1,
-                                dets[k, 2] + 1, dets[k, 3] + 1))
-
-    def _do_python_eval(self, output_dir='output', thresh=0.5):
+                for (im_ind, box, score) in zip(image_idx, boxes, scores):
+                    f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
+                            format(self.ids[im_ind][1], score,
+                            box[0] + 1, box[1] + 1,
+                            box[2] + 1, box[3] + 1))
+
+    def _do_python_eval(self, detections, output_dir='output', thresholds=(0.5,)):
         rootpath = os.path.join(self.root, 'VOC' + self._year)
-        name = self.image_set[0][1]
         annopath = os.path.join(
                                 rootpath,
                                 'Annotations',
                                 '{:s}.xml')
-        imagesetfile = os.path.join(
-                                rootpath,
-                                'ImageSets',
-                                'Main',
-                                name+'.txt')
+        imagenames = [index[1] for index in self.ids]
         cachedir = os.path.join(self.root, 'annotations_cache')
+        recs = load_recs(annopath, imagenames, cachedir)  # once for all the classes and thresholds
         aps = []
         # The PASCAL VOC metric changed in 2010
         use_07_metric = True if int(self._year) < 2010 else False
-        #print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if output_dir is not None and not os.path.isdir(output_dir):
             os.mkdir(output_dir)
         for i, cls in enumerate(VOC_CLASSES):
@@ -239,41 +303,35 @@ class VOCDetection(data.Dataset):
             if cls == '__background__':
                 continue
 
-            filename = self._get_voc_results_file_template().format(cls)
-            rec, prec, ap = voc_eval(filename, annopath, imagesetfile, cls, cachedir, ovthresh=thresh,
-                                    use_07_metric=use_07_metric)
+            (gt_boxes, gt_difficult, npos) = class_gt(recs, imagenames, cls)
+            (image_idx, boxes, scores) = detections.class_detections(i)
+            # +1 for the 1-based coordinates of the annotations, as in the results files
+            rec, prec, ap = voc_eval_arrays(image_idx, scores, boxes + 1, gt_boxes, gt_difficult, npos,
+                                            ovthresh=thresholds, use_07_metric=use_07_metric)
             aps += [ap]
-            #print('AP for {} = {:.4f}'.format(cls, ap))
             if output_dir is not None:
                 with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
-                    pickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
-        #print('Thresh = {:.4f} Mean AP = {:.4f}'.format(thresh, np.mean(aps)))
-        """print('~~~~~~~~')
-        print('Results:')
-        for ap in aps:
-            print('{:.3f}'.format(ap))
-        print('{:.3f}'.format(np.mean(aps)))
-        print('~~~~~~~~')
-        print('')
-        print('--------------------------------------------------------------')
-        print('Results computed with the **unofficial** Python eval code.')
-        print('Results should be very close to the official MATLAB eval code.')
-        print('Recompute with `./tools/reval.py --matlab ...` for your paper.')
-        print('-- Thanks, The Management')
-        print('--------------------------------------------------------------')"""
-        return np.mean(aps)
-
-def detection_collate(batch):
+                    pickle.dump({'rec': rec[0], 'prec': prec[0], 'ap': ap[0]}, f)
+        return np.mean(aps, axis=0)  # mean AP of each threshold
+
+def detection_collate(batch, packed=False):
     """Custom collate fn for dealing with batches of images that have a different
     number of associated object annotations (bounding boxes).
 
     Arguments:
         batch: (tuple) A tuple of tensor images and lists of annotations
+        packed: (bool) pad the annotations into a single tensor instead of
+            returning a list, use with DataLoader(pin_memory=True) so that the
+            whole batch is moved to the device in one non_blocking copy
 
     Return:
         A tuple containing:
             1) (tensor) batch of images stacked on their 0 dim
             2) (list of tensors) annotations for a given image are stacked on 0 dim
+        or, if packed:
+            2) (tensor) annotations padded with zeros, Shape: [batch, max_obj, 5]
+            3) (tensor) number of objects for each image, Shape: [batch]
+            4) (tensor) mask of the non-padded annotations, Shape: [batch, max_obj]
     """
     targets = []
     imgs = []
@@ -285,4 +343,13 @@ def detection_collate(batch):
                 annos = torch.from_numpy(tup).float()
                 targets.append(annos)
 
-    return (torch.stack(imgs, 0), targets)
\ No newline at end of file
+    if not packed:
+        return (torch.stack(imgs, 0), targets)
+
+    num_obj = torch.LongTensor([anno.size(0) for anno in targets])
+    max_obj = max([anno.size(0) for anno in targets] + [1])
+    padded = torch.zeros(len(targets), max_obj, 5)
+    for (idx, anno) in enumerate(targets):
+        padded[idx, :anno.size(0)] = anno
+    valid = torch.arange(max_obj).unsqueeze(0) < num_obj.unsqueeze(1)
+    return (torch.stack(imgs, 0), padded, num_obj, valid)
@@ -35,14 +35,14 @@ def voc_ap(rec, prec, use_07_metric=False):
     VOC 07 11 point method (default:False).
     """
     if use_07_metric:
-        # 11 point metric
+        # 11 point metric: max precision at recall >= t, recall is non-decreasing
+        t = np.arange(0., 1.1, 0.1)
+        npre = np.maximum.accumulate(prec[::-1])[::-1] if prec.size > 0 else np.zeros(1)
+        num_above = np.sum(rec[np.newaxis, :] >= t[:, np.newaxis], axis=1)
+        p = np.where(num_above > 0, npre[np.minimum(rec.size - num_above, npre.size - 1)], 0)
         ap = 0.
-        for t in np.arange(0., 1.1, 0.1):
-            if np.sum(rec >= t) == 0:
-                p = 0
-            else:
-                p = np.max(prec[rec >= t])
-            ap = ap + p / 11.
+        for k in range(t.size):
+            ap = ap + p[k] / 11.
     else:
         # correct AP calculation
         # first append sentinel values at the end
@@ -50,8 +50,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -61,6 +60,145 @@ def voc_ap(rec, prec, use_07_metric=False):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+def load_recs(annopath, imagenames, cachedir):
+    """recs = load_recs(annopath, imagenames, cachedir)
+
+    Parse the annotations of imagenames, cached in cachedir/annots.pkl.
+    Returns a dict imagename -> list of objects of parse_rec().
+    """
+    if not os.path.isdir(cachedir):
+        os.mkdir(cachedir)
+    cachefile = os.path.join(cachedir, 'annots.pkl')
+    if not os.path.isfile(cachefile):
+        # load annots
+        recs = {}
+        for i, imagename in enumerate(imagenames):
+            recs[imagename] = parse_rec(annopath.format(imagename))
+            if i % 100 == 0:
+                print('Reading annotation for {:d}/{:d}'.format(
+                    i + 1, len(imagenames)))
+        # save
+        print('Saving cached annotations to {:s}'.format(cachefile))
+        with open(cachefile, 'wb') as f:
+            pickle.dump(recs, f)
+    else:
+        # load
+        with open(cachefile, 'rb') as f:
+            recs = pickle.load(f)
+    return recs
+
+def class_gt(recs, imagenames, classname):
+    """gt_boxes, gt_difficult, npos = class_gt(recs, imagenames, classname)
+
+    Ground truth of one class as a [G, 4] box array and a [G] difficult
+    array per image, in the order of imagenames, and the number of
+    non-difficult objects.
+    """
+    gt_boxes = []
+    gt_difficult = []
+    npos = 0
+    for imagename in imagenames:
+        R = [obj for obj in recs[imagename] if obj['name'] == classname]
+        gt_boxes.append(np.array([x['bbox'] for x in R], dtype=np.float64).reshape(-1, 4))
+        gt_difficult.append(np.array([x['difficult'] for x in R], dtype=bool))
+        npos = npos + int(np.sum(~gt_difficult[-1]))
+    return gt_boxes, gt_difficult, npos
+
+def voc_eval_arrays(image_idx,
+                    scores,
+                    boxes,
+                    gt_boxes,
+                    gt_difficult,
+                    npos,
+                    ovthresh=(0.5,),
+                    use_07_metric=False,
+                    chunk_size=16384):
+    """rec, prec, ap = voc_eval_arrays(image_idx, scores, boxes,
+                                       gt_boxes, gt_difficult, npos,
+                                       [ovthresh],
+                                       [use_07_metric],
+                                       [chunk_size])
+
+    Same evaluation as voc_eval() on in-memory detections of one class,
+    for several overlap thresholds at once: the overlaps with the ground
+    truth are computed once, by chunks of detections, and TPs / FPs are
+    marked as [T, D] arrays.
+
+    image_idx: [D] image of each detection, index in gt_boxes
+    scores: [D] confidence of each detection
+    boxes: [D, 4] detections, in the coordinates of the annotations
+    gt_boxes, gt_difficult, npos: ground truth from class_gt()
+    [ovthresh]: Overlap thresholds (default = (0.5,))
+    [use_07_metric]: Whether to use VOC07's 11 point AP computation
+        (default False)
+    [chunk_size]: Detections whose overlaps are computed at once
+        (default 16384)
+
+    Returns [T, D] recall and precision and [T] AP, T = len(ovthresh).
+    """
+    ovthresh = np.asarray(ovthresh, dtype=np.float64).reshape(-1)
+
+    # sort by confidence
+    sorted_ind = np.argsort(-scores, kind='stable')
+    BB = boxes[sorted_ind].astype(float)
+    image_idx = image_idx[sorted_ind]
+    nd = len(image_idx)
+
+    # ground truth flattened across the images
+    num_gt = np.array([len(gt) for gt in gt_boxes], dtype=np.int64)
+    gt_offset = np.concatenate(([0], np.cumsum(num_gt)))
+    all_gt = np.concatenate([np.asarray(gt, dtype=np.float64).reshape(-1, 4) for gt in gt_boxes] + [np.zeros((1, 4))])
+    all_difficult = np.concatenate([np.asarray(d, dtype=bool) for d in gt_difficult] + [np.zeros(1, dtype=bool)])
+
+    # best gt overlap of every detection, by chunks of detections padded to
+    # the most gt of their images, so that memory does not grow with [D, G_max]
+    jmax = np.zeros(nd, dtype=np.int64)
+    ovmax = np.full(nd, -np.inf)
+    difficult = np.zeros(nd, dtype=bool)
+    for start in range(0, nd, chunk_size):
+        d = slice(start, min(start + chunk_size, nd))
+        d_gt = num_gt[image_idx[d]]
+        G = max(int(d_gt.max()), 1)
+        gt_ind = np.minimum(gt_offset[image_idx[d]][:, np.newaxis] + np.arange(G), len(all_gt) - 1)
+        bb = BB[d][:, np.newaxis, :]
+        BBGT = all_gt[gt_ind]
+        ixmin = np.maximum(BBGT[:, :, 0], bb[:, :, 0])
+        iymin = np.maximum(BBGT[:, :, 1], bb[:, :, 1])
+        ixmax = np.minimum(BBGT[:, :, 2], bb[:, :, 2])
+        iymax = np.minimum(BBGT[:, :, 3], bb[:, :, 3])
+        iw = np.maximum(ixmax - ixmin + 1., 0.)
+        ih = np.maximum(iymax - iymin + 1., 0.)
+        inters = iw * ih
+        uni = ((bb[:, :, 2] - bb[:, :, 0] + 1.) * (bb[:, :, 3] - bb[:, :, 1] + 1.) +
+               (BBGT[:, :, 2] - BBGT[:, :, 0] + 1.) *
+               (BBGT[:, :, 3] - BBGT[:, :, 1] + 1.) - inters)
+        overlaps = inters / uni
+        overlaps[np.arange(G)[np.newaxis, :] >= d_gt[:, np.newaxis]] = -np.inf
+        jmax[d] = np.argmax(overlaps, axis=1)
+        ovmax[d] = overlaps[np.arange(len(d_gt)), jmax[d]]
+        difficult[d] = all_difficult[gt_ind[np.arange(len(d_gt)), jmax[d]]]
+
+    # TPs and FPs of all the thresholds, [T, D]: a detection is a TP if it is
+    # the highest scored one matching its gt, matching a difficult gt is
+    # neither TP nor FP, the others are FPs
+    hit = ovmax[np.newaxis, :] > ovthresh[:, np.newaxis]
+    cand = hit & ~difficult[np.newaxis, :]
+    (t_ind, d_ind) = np.where(cand)  # by threshold then score
+    key = t_ind * max(int(gt_offset[-1]), 1) + (gt_offset[image_idx] + jmax)[d_ind]
+    first = np.unique(key, return_index=True)[1]
+    tp = np.zeros((len(ovthresh), nd))
+    tp[t_ind[first], d_ind[first]] = 1.
+    fp = (~hit | (cand & (tp == 0))).astype(np.float64)
+
+    # compute precision recall
+    fp = np.cumsum(fp, axis=1)
+    tp = np.cumsum(tp, axis=1)
+    rec = tp / float(npos)
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = np.array([voc_ap(rec[t], prec[t], use_07_metric) for t in range(len(ovthresh))])
+
+    return rec, prec, ap
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
@@ -94,30 +232,11 @@ def voc_eval(detpath,
     # cachedir caches the annotations in a pickle file
 
     # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl')
     # read list of images
     with open(imagesetfile, 'r') as f:
         lines = f.readlines()
     imagenames = [x.split('/')[-1].split('.')[0].strip().strip() for x in lines]
-
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename))
-            if i % 100 == 0:
-                print('Reading annotation for {:d}/{:d}'.format(
-                    i + 1, len(imagenames)))
-        # save
-        print('Saving cached annotations to {:s}'.format(cachefile))
-        with open(cachefile, 'wb') as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'rb') as f:
-            recs = pickle.load(f)
+    recs = load_recs(annopath, imagenames, cachedir)
 
     # extract gt objects for this class
     class_recs = {}
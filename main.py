@@ -3,11 +3,14 @@
 
 import os
 import sys
+import builtins
+import platform
 import argparse
 import math
 import numpy as np
 import cv2
 import random
+from functools import partial
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -15,12 +18,14 @@ import torch.backends.cudnn as cudnn
 import torchvision.transforms as transforms
 from torch.autograd import Variable
 import torch.utils.data as data
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from data import AnnotationTransform, BaseTransform
-from data import detection_collate, preproc
+from data import detection_collate, preproc, DataPrefetcher, EvalDataset, EvalCache, DetectionStore
 from utils import PriorBox, Detect
 from utils import MultiBoxLoss
 from utils import Timer
-from utils.box import nms
+from utils.box import nms, nms_matrix, multiclass_nms
 cudnn.benchmark = True
 
 ### For Reproducibility ###
@@ -36,6 +41,18 @@ cudnn.benchmark = True
 # cudnn.enabled = True
 ### For Reproducibility ###
 
+def input_size(size):
+    """--size as an int, or (height, width) for HxW"""
+    (height, _, width) = size.lower().partition('x')
+    if not width or int(height) == int(width):
+        return int(height)
+    return (int(height), int(width))
+
+
+def size_name(size):
+    return ('{}x{}'.format(*size) if isinstance(size, tuple) else str(size))
+
+
 parser = argparse.ArgumentParser(description='Pytorch Training')
 parser.add_argument('--neck', default='pafpn')
 parser.add_argument('--backbone', default='repvgg')
@@ -43,15 +60,29 @@ parser.add_argument('--dataset', default='VOC')
 parser.add_argument('--save_folder', default='weights/')
 parser.add_argument('--mutual_guide', action='store_true')
 parser.add_argument('--base_anchor_size', default=24.0, type=float)
-parser.add_argument('--size', default=320, type=int)
+parser.add_argument('--size', default=320, type=input_size, help='Input size, e.g. 320, or HxW for non-square inputs, e.g. 384x640')
+parser.add_argument('--letterbox', action='store_true', help='Keep the aspect ratio of the images and pad them to the input size')
 parser.add_argument('--nms_thresh', default=0.5, type=float)
+parser.add_argument('--nms', default='batched', choices=['batched', 'greedy', 'matrix'], help='NMS used for evaluation, batched on the device, or greedy / iou matrix per class on cpu')
+parser.add_argument('--pre_nms_top_k', default=0, type=int, help='Candidates kept before NMS, per image for batched and per class otherwise, 0 to keep all')
 parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--num_workers', default=4, type=int, help='Number of data loading workers')
+parser.add_argument('--prefetch_factor', default=2, type=int, help='Batches loaded in advance by each worker')
 parser.add_argument('--lr', default=1e-2, type=float)
 parser.add_argument('--warm_iter', default=500, type=int)
 parser.add_argument('--trained_model', help='Location to trained model')
 parser.add_argument('--draw', action='store_true', help='Draw detection results')
+parser.add_argument('--eval_cache', action='store_true', help='Cache the preprocessed test images on disk')
+parser.add_argument('--lazy_image_check', action='store_true', help='Report missing COCO images when they are read instead of listing the image folders at startup')
+parser.add_argument('--save_detections', help='Save the detections to this .npz file')
+parser.add_argument('--load_detections', help='Evaluate the detections of this .npz file without inference')
+parser.add_argument('--eval_workers', default=0, type=int, help='Processes for the COCO evaluation, 0 to evaluate in the main process')
+parser.add_argument('--result_format', default='json', choices=['json', 'npy'], help='Format of the COCO results file')
+parser.add_argument('--eval_batch_size', default=8, type=int, help='Batch size for evaluation')
+parser.add_argument('--device', default='cuda', help='Device to run on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--amp', action='store_true', help='Train with automatic mixed precision')
+parser.add_argument('--dist_backend', default=None, help='Backend for distributed training launched by torchrun, nccl or gloo, by default nccl on cuda and gloo otherwise')
 args = parser.parse_args()
-print(args)
 
 
 def adjust_learning_rate(optimizer, epoch, iteration, warm_iter, max_iter):
@@ -76,14 +107,37 @@ def tencent_trick(model):
     return [{'params': no_decay, 'weight_decay': 0.0}, {'params': decay}]
 
 
-def load_dataset():
+def init_distributed(device):
+    # torchrun sets WORLD_SIZE/RANK/LOCAL_RANK, a plain launch trains in one process
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return (0, 1, device)
+    rank = int(os.environ['RANK'])
+    if rank != 0:
+        builtins.print = (lambda *args, **kwargs: None)  # only rank 0 logs, including the data modules
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+    backend = (args.dist_backend or ('nccl' if device.type == 'cuda' else 'gloo'))
+    dist.init_process_group(backend=backend)
+    return (rank, world_size, device)
+
+
+def load_dataset(batch_size):
+    dataset = None
+    if os.path.isdir(args.dataset):
+        # training set packed with data/shards.py, evaluation on its source dataset
+        from data.shards import ShardDetection
+        dataset = ShardDetection(args.dataset, preproc(args.size, letterbox=args.letterbox))
+        args.dataset = dataset.source
     if args.dataset == 'VOC':
         from data import VOCroot, VOCDetection, VOC_CLASSES
         show_classes = VOC_CLASSES
         num_classes = len(VOC_CLASSES)
         train_sets = [('2007', 'trainval'), ('2012', 'trainval')]
-        dataset = VOCDetection(VOCroot, train_sets, preproc(args.size), AnnotationTransform(), dataset_name='VOC0712trainval')
-        epoch_size = len(dataset) // args.batch_size
+        if dataset is None:
+            dataset = VOCDetection(VOCroot, train_sets, preproc(args.size, letterbox=args.letterbox), AnnotationTransform(), dataset_name='VOC0712trainval')
+        epoch_size = len(dataset) // batch_size
         max_iter = 250 * epoch_size
         testset = VOCDetection(VOCroot, [('2007', 'test')], None)
     elif args.dataset == 'COCO':
@@ -91,21 +145,34 @@ def load_dataset():
         show_classes = COCO_CLASSES
         num_classes = len(COCO_CLASSES)
         train_sets = [('2017', 'train')]
-        dataset = COCODetection(COCOroot, train_sets, preproc(args.size))
-        epoch_size = len(dataset) // args.batch_size
+        if dataset is None:
+            dataset = COCODetection(COCOroot, train_sets, preproc(args.size, letterbox=args.letterbox), check_images=not args.lazy_image_check)
+        epoch_size = len(dataset) // batch_size
         max_iter = 140 * epoch_size
-        testset = COCODetection(COCOroot, [('2017', 'val')], None)
+        testset = COCODetection(COCOroot, [('2017', 'val')], None, check_images=not args.lazy_image_check)
     else:
         raise NotImplementedError('Unkown dataset {}!'.format(args.dataset))
     return (show_classes, num_classes, dataset, epoch_size, max_iter, testset)
 
 
+def device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return platform.processor() or 'CPU'
+
+
+def evaluate_detections(testset, detections):
+    if args.dataset == 'COCO':
+        return testset.evaluate_detections(detections, workers=args.eval_workers, result_format=args.result_format)
+    return testset.evaluate_detections(detections)
+
+
 def save_weights(model):
     save_path = os.path.join(args.save_folder, '{}_{}_{}_size{}_anchor{}{}.pth'.format(
         args.dataset,
         args.neck,
         args.backbone,
-        args.size,
+        size_name(args.size),
         args.base_anchor_size,
         ('_MG' if args.mutual_guide else ''),
         ))
@@ -115,57 +182,98 @@ def save_weights(model):
 
 if __name__ == '__main__':
 
+    device = torch.device(args.device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise ValueError('Error: CUDA is not available, use --device cpu')
+    (rank, world_size, device) = init_distributed(device)
+    print(args)
+    if world_size > 1:
+        # linear scaling rule, --batch_size and --lr are given per process
+        args.lr *= world_size
+        print('Rank {}/{} on {}, lr scaled to {} for a global batch size of {}'.format(
+            rank, world_size, device, args.lr, args.batch_size * world_size))
+
     print('Loading Dataset...')
-    (show_classes, num_classes, dataset, epoch_size, max_iter, testset) =  load_dataset()
+    (show_classes, num_classes, dataset, epoch_size, max_iter, testset) =  load_dataset(args.batch_size * world_size)
+    if args.load_detections is not None:
+        print('Loading detections from {}'.format(args.load_detections))
+        detections = DetectionStore.load(args.load_detections)
+        if len(detections) != len(testset):
+            raise ValueError('Error: {} has detections for {} images, the {} test set has {}!'.format(
+                args.load_detections, len(detections), args.dataset, len(testset)))
+        labels = detections.labels[:detections.num_dets]
+        if len(labels) > 0 and (labels.min() < 1 or labels.max() >= num_classes):
+            raise ValueError('Error: {} has class labels in [{}, {}], the {} classes are 1 to {}!'.format(
+                args.load_detections, labels.min(), labels.max(), args.dataset, num_classes - 1))
+        evaluate_detections(testset, detections)
+        sys.exit(0)
 
     print('Loading Network...')
     from models.detector import Detector
     model = Detector(args.size, num_classes, args.backbone, args.neck)
     model.train()
-    model.cuda()
+    model.to(device)
     num_param = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('Total param is : {:e}'.format(num_param))
 
     print('Preparing Optimizer & AnchorBoxes...')
     optimizer = optim.SGD(tencent_trick(model), lr=args.lr, momentum=0.9, weight_decay=0.0005)
     criterion = MultiBoxLoss(num_classes, mutual_guide=args.mutual_guide)
-    priorbox = PriorBox(args.base_anchor_size, args.size)
+    priorbox = PriorBox(args.base_anchor_size, args.size, device=device)
     with torch.no_grad():
         priors = priorbox.forward()
-        priors = priors.cuda()
 
     if args.trained_model is not None:
         print('loading weights from', args.trained_model)
-        state_dict = torch.load(args.trained_model)
+        state_dict = torch.load(args.trained_model, map_location=device)
         model.load_state_dict(state_dict, strict=True)
     else:
         print('Training {}-{} on {} with {} images'.format(args.neck, args.backbone, dataset.name, len(dataset)))
         os.makedirs(args.save_folder, exist_ok=True)
         epoch = 0
         timer = Timer()
+        scaler = torch.amp.GradScaler(device.type, enabled=(args.amp and device.type == 'cuda'))
+        if world_size > 1:
+            train_model = DistributedDataParallel(model, device_ids=([device] if device.type == 'cuda' else None))
+        else:
+            train_model = model
+        if hasattr(dataset, 'shard_of'):
+            from data.shards import ShardSampler
+            sampler = ShardSampler(dataset, shuffle=True, num_replicas=world_size, rank=rank)
+        elif world_size > 1:
+            sampler = data.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        else:
+            sampler = None
+
+        # one loader for the whole training, its workers are kept alive between epochs
+        loader_kwargs = (dict(persistent_workers=True, prefetch_factor=args.prefetch_factor) if args.num_workers > 0 else dict())
+        rand_loader = data.DataLoader(dataset, args.batch_size, shuffle=(sampler is None), sampler=sampler, num_workers=args.num_workers,
+                                      collate_fn=partial(detection_collate, packed=True), pin_memory=(device.type == 'cuda'), **loader_kwargs)
+        prefetcher = DataPrefetcher(rand_loader, device)
         for iteration in range(max_iter):
             if iteration % epoch_size == 0:
 
                 # create batch iterator
 
-                rand_loader = data.DataLoader(dataset, args.batch_size, shuffle=True, num_workers=4, collate_fn=detection_collate)
-                batch_iterator = iter(rand_loader)
+                if sampler is not None:
+                    sampler.set_epoch(epoch)
+                batch_iterator = iter(prefetcher)
                 epoch += 1
 
             timer.tic()
             adjust_learning_rate(optimizer, epoch, iteration, args.warm_iter, max_iter)
-            (images, targets) = next(batch_iterator)
-            images = Variable(images.cuda())
-            targets = [Variable(anno.cuda()) for anno in targets]
-            out = model(images)
-            (loss_l, loss_c) = criterion(out, priors, targets)
+            (images, targets, num_obj, valid) = next(batch_iterator)
+            with torch.amp.autocast(device.type, enabled=args.amp):
+                out = train_model(images)
+            (loss_l, loss_c) = criterion(out, priors, targets, valid)  # always in fp32
             loss = loss_l + loss_c
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             load_time = timer.toc()
 
-            if iteration % 100 == 0:
+            if iteration % 100 == 0 and rank == 0:
                 print('Epoch {}, iter {}, lr {:.6f}, loss {:.2f}, time {:.2f}s, eta {:.2f}h'.format(
                     epoch,
                     iteration,
@@ -175,66 +283,95 @@ if __name__ == '__main__':
                     load_time * (max_iter - iteration) / 3600,
                     ))
                 timer.clear()
-        save_weights(model)
+        if rank == 0:
+            save_weights(model)
+
+    if world_size > 1:
+        dist.destroy_process_group()
+        if rank != 0:
+            sys.exit(0)
     
     print('Start Evaluation...')
     thresh=0.005
     max_per_image=300
     model.eval()
     detector = Detect(num_classes)
-    transform = BaseTransform(args.size)
+    transform = BaseTransform(args.size, letterbox=args.letterbox)
     num_images = len(testset)
-    all_boxes = [[[] for _ in range(num_images)] for _ in range(num_classes)]
+    detections = DetectionStore(num_images)
     rgbs = dict()
     os.makedirs("draw/", exist_ok=True)
     os.makedirs("draw/{}/".format(args.dataset), exist_ok=True)
     _t = {'im_detect': Timer(), 'im_nms': Timer()}
-    for i in range(num_images):
-        img = testset.pull_image(i)
-        scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
+    cache_size = size_name(args.size) + ('_letterbox' if args.letterbox else '')
+    eval_set = (EvalCache.open(testset, transform, cache_size) if args.eval_cache else EvalDataset(testset, transform))
+    eval_loader = data.DataLoader(eval_set, args.eval_batch_size, shuffle=False, num_workers=args.num_workers,
+                                  pin_memory=(device.type == 'cuda'))
+    num_batches = len(eval_loader)
+    num_timed = 0  # images in the timers, the last batch may be smaller
+    i = 0
+    for (batch_idx, (x, scale, offset, size)) in enumerate(eval_loader):
         with torch.no_grad():
-            x = transform(img).unsqueeze(0)
-            (x, scale) = (x.cuda(), scale.cuda())
+            (x, scale, offset, size) = (x.to(device, non_blocking=True), scale.to(device, non_blocking=True),
+                                        offset.to(device, non_blocking=True), size.to(device, non_blocking=True))
 
             _t['im_detect'].tic()
             out = model(x)  # forward pass
-            (boxes, scores) = detector.forward(out, priors)
-            detect_time = _t['im_detect'].toc()
-
-        boxes *= scale  # scale each detection back up to the image
-        boxes = boxes.cpu().numpy()
-        scores = scores.cpu().numpy()
-
-        _t['im_nms'].tic()
-        for j in range(1, num_classes):
-            inds = np.where(scores[:, j - 1] > thresh)[0]
-            if len(inds) == 0:
-                all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
-                continue
-            c_bboxes = boxes[inds]
-            c_scores = scores[inds, j - 1]
-            c_dets = np.hstack((c_bboxes, c_scores[:, np.newaxis])).astype(np.float32, copy=False)
-            keep = nms(c_dets, thresh=args.nms_thresh)  # non maximum suppression
-            c_dets = c_dets[keep, :]
-            all_boxes[j][i] = c_dets
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1, num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
+            (batch_boxes, batch_scores) = detector.forward(out, priors)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            _t['im_detect'].toc()
+            num_timed += x.size(0)
+            detect_time = _t['im_detect'].total_time / num_timed  # per image
+
+        batch_boxes *= scale.unsqueeze(1)  # scale each detection back up to the image
+        batch_boxes -= offset.unsqueeze(1)  # and remove the letterbox padding
+        batch_boxes = torch.minimum(batch_boxes.clamp_(min=0), size.unsqueeze(1))  # boxes on the padding stay in the image
+        if args.nms == 'batched':
+            _t['im_nms'].tic()
+            batch_dets = multiclass_nms(batch_boxes, batch_scores, thresh, args.nms_thresh, args.pre_nms_top_k, max_per_image)
+            batch_dets = [dets.cpu().numpy() for dets in batch_dets]
+            _t['im_nms'].toc()
+            nms_time = _t['im_nms'].total_time / num_timed  # per image
+        else:
+            cpu_nms = (nms_matrix if args.nms == 'matrix' else nms)
+            batch_boxes = batch_boxes.cpu().numpy()
+            batch_scores = batch_scores.cpu().numpy()
+
+        for b in range(x.size(0)):
+            # detections of the image as one flat (xmin, ymin, xmax, ymax, score, class) array
+            if args.nms == 'batched':
+                dets = batch_dets[b]
+            else:
+                (boxes, scores) = (batch_boxes[b], batch_scores[b])
+                _t['im_nms'].tic()
+                dets = [np.empty([0, 6], dtype=np.float32)]
                 for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        nms_time = _t['im_nms'].toc()
-
-        if args.draw:
-            for j in range(1, num_classes):
-                c_dets = all_boxes[j][i]
-                for line in c_dets:
+                    inds = np.where(scores[:, j - 1] > thresh)[0]
+                    if len(inds) == 0:
+                        continue
+                    if args.pre_nms_top_k > 0 and len(inds) > args.pre_nms_top_k:
+                        inds = inds[np.argpartition(-scores[inds, j - 1], args.pre_nms_top_k)[:args.pre_nms_top_k]]
+                    c_dets = np.hstack((boxes[inds], scores[inds, j - 1, np.newaxis], np.full((len(inds), 1), j))).astype(np.float32, copy=False)
+                    keep = cpu_nms(c_dets[:, :5], thresh=args.nms_thresh)  # non maximum suppression
+                    dets.append(c_dets[keep])
+                dets = np.concatenate(dets)
+                if max_per_image > 0 and len(dets) > max_per_image:
+                    top = np.argpartition(-dets[:, 4], max_per_image - 1)[:max_per_image]
+                    dets = dets[np.sort(top)]  # keep the class and score order
+                nms_time = _t['im_nms'].toc()
+
+            detections.add(i, dets)
+
+            if args.draw:
+                img = testset.pull_image(i)
+                for line in dets:
                     x1 = int(line[0])
                     y1 = int(line[1])
                     x2 = int(line[2])
                     y2 = int(line[3])
                     score = float(line[4])
+                    j = int(line[5])
                     if score > .25:
                         if j not in rgbs:
                             r = random.randint(0,255)
@@ -246,14 +383,21 @@ if __name__ == '__main__':
                         cv2.rectangle(img, (x1, y1), (x2, y2), rgb, 2)
                         cv2.rectangle(img, (x1, y1-15), (x1+len(label)*9, y1), rgb, -1)
                         img = cv2.putText(img, label, (x1, y1-5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1, cv2.LINE_AA)
-            img = cv2.putText(img, 'Resolution {}x{} detect {:.2f}ms on {}'.format(args.size, args.size, detect_time*1000, torch.cuda.get_device_name(0)), (20, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,255), 1, cv2.LINE_AA)
-            filename = 'draw/{}/{}.jpg'.format(args.dataset, i)
-            cv2.imwrite(filename, img)
+                (in_h, in_w) = (args.size if isinstance(args.size, tuple) else (args.size, args.size))
+                img = cv2.putText(img, 'Resolution {}x{} detect {:.2f}ms on {}'.format(in_w, in_h, detect_time*1000, device_name(device)), (20, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,255), 1, cv2.LINE_AA)
+                filename = 'draw/{}/{}.jpg'.format(args.dataset, i)
+                cv2.imwrite(filename, img)
 
-        if i == 10:
+            i += 1
+
+        if batch_idx == 0:  # warm-up
             _t['im_detect'].clear()
             _t['im_nms'].clear()
-        if i % math.floor(num_images / 10) == 0 and i > 0:
-            print('[{}/{}]Time results: detect={:.2f}ms,nms={:.2f}ms,'.format(i, num_images, detect_time * 1000, nms_time * 1000))
-    testset.evaluate_detections(all_boxes)
-
+            num_timed = 0
+        if (batch_idx + 1) % max(num_batches // 10, 1) == 0:
+            print('[{}/{}]Time results: detect={:.2f}ms ({:.1f} images/s),nms={:.2f}ms,'.format(
+                i, num_images, detect_time * 1000, 1.0 / max(detect_time, 1e-12), nms_time * 1000))
+    if args.save_detections is not None:
+        print('Saving detections to {}'.format(args.save_detections))
+        detections.save(args.save_detections)
+    evaluate_detections(testset, detections)
@@ -21,10 +21,11 @@ class Detector(nn.Module):
     def __init__(self, size, num_classes, backbone, neck):
         super(Detector, self).__init__()
 
-        # Params
-        if not size % 64 == 0:
+        # Params, size is an int or (height, width)
+        (height, width) = (size if isinstance(size, (tuple, list)) else (size, size))
+        if not (height % 64 == 0 and width % 64 == 0):
             raise ValueError('Error: Sorry size {} is not supported!'.format(size))
-        self.fpn_level = (4 if size < 512 else 5)
+        self.fpn_level = (4 if max(height, width) < 512 else 5)
         self.num_classes = num_classes - 1
         self.num_anchors = 6
 
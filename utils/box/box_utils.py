@@ -6,6 +6,7 @@ import torch.nn.functional as F
 import math
 import numpy as np
 import torch.backends.cudnn as cudnn
+from torchvision.ops import batched_nms
 
 
 def point_form(boxes):
@@ -38,29 +39,27 @@ def intersect(box_a, box_b):
     [A,2] -> [A,1,2] -> [A,B,2]
     [B,2] -> [1,B,2] -> [A,B,2]
     Then we compute the area of intersect between box_a and box_b.
+    Leading batch dimensions are broadcast, so padded per-image boxes
+    of shape [batch,A,4] can be compared with priors of shape [B,4].
     Args:
-      box_a: (tensor) bounding boxes, Shape: [A,4].
-      box_b: (tensor) bounding boxes, Shape: [B,4].
+      box_a: (tensor) bounding boxes, Shape: [A,4] or [batch,A,4].
+      box_b: (tensor) bounding boxes, Shape: [B,4] or [batch,B,4].
     Return:
-      (tensor) intersection area, Shape: [A,B].
+      (tensor) intersection area, Shape: [A,B] or [batch,A,B].
     """
 
-    A = box_a.size(0)
-    B = box_b.size(0)
-    max_xy = torch.min(box_a[:, 2:].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, 2:].unsqueeze(0).expand(A, B, 2))
-    min_xy = torch.max(box_a[:, :2].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, :2].unsqueeze(0).expand(A, B, 2))
+    max_xy = torch.min(box_a[..., :, None, 2:], box_b[..., None, :, 2:])
+    min_xy = torch.max(box_a[..., :, None, :2], box_b[..., None, :, :2])
     inter = torch.clamp(max_xy - min_xy, min=0)
-    return inter[:, :, 0] * inter[:, :, 1]
+    return inter[..., 0] * inter[..., 1]
 
 
 def jaccard(box_a, box_b):
     '''Compute the jaccard overlap of two sets of boxes.  The jaccard overlap\n    is simply the intersection over union of two boxes.  Here we operate on\n    ground truth boxes and default boxes.\n    E.g.:\n        A \xe2\x88\xa9 B / A \xe2\x88\xaa B = A \xe2\x88\xa9 B / (area(A) + area(B) - A \xe2\x88\xa9 B)\n    Args:\n        box_a: (tensor) Ground truth bounding boxes, Shape: [num_objects,4]\n        box_b: (tensor) Prior boxes from priorbox layers, Shape: [num_priors,4]\n    Return:\n        jaccard overlap: (tensor) Shape: [box_a.size(0), box_b.size(0)]\n    '''
 
     inter = intersect(box_a, box_b)
-    area_a = ((box_a[:, 2] - box_a[:, 0]) * (box_a[:, 3] - box_a[:, 1])).unsqueeze(1).expand_as(inter)  # [A,B]
-    area_b = ((box_b[:, 2] - box_b[:, 0]) * (box_b[:, 3] - box_b[:, 1])).unsqueeze(0).expand_as(inter)  # [A,B]
+    area_a = ((box_a[..., 2] - box_a[..., 0]) * (box_a[..., 3] - box_a[..., 1])).unsqueeze(-1).expand_as(inter)  # [A,B]
+    area_b = ((box_b[..., 2] - box_b[..., 0]) * (box_b[..., 3] - box_b[..., 1])).unsqueeze(-2).expand_as(inter)  # [A,B]
     union = area_a + area_b - inter
     return inter / union  # [A,B]
 
@@ -92,6 +91,38 @@ def match(truths, priors, labels, loc_t, conf_t, overlap_t, idx):
     loc_t[idx] = truths[best_truth_idx]  # Shape: [num_priors,4]
 
 
+def match_batch(truths, priors, labels, valid, loc_t, conf_t, overlap_t):
+    """Batched version of match for the whole mini-batch. Images with fewer
+    objects are padded up to max_obj, the padded rows are masked out by valid.
+    Args:
+        truths: (tensor) Padded ground truth boxes, Shape: [batch, max_obj, 4].
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors, 4].
+        labels: (tensor) Padded class labels, Shape: [batch, max_obj].
+        valid: (tensor) Mask of the non-padded objects, Shape: [batch, max_obj].
+        loc_t: (tensor) Tensor to be filled w/ endcoded location targets.
+        conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds.
+        overlap_t: (tensor) Tensor to be filled w/ iou score for each priors.
+    """
+
+    (num, num_obj) = labels.size()
+    num_priors = priors.size(0)
+    overlaps = jaccard(truths, point_form(priors))  # [batch,max_obj,num_priors]
+    overlaps.masked_fill_(~valid.unsqueeze(-1), -1.0)
+    (best_truth_overlap, best_truth_idx) = overlaps.max(1)
+    (best_prior_overlap, best_prior_idx) = overlaps.max(2)
+
+    # ensure best prior, the last object wins as in the sequential assignment
+    obj_idx = torch.arange(num_obj, device=truths.device).expand(num, num_obj).masked_fill(~valid, -1)
+    forced_idx = torch.full_like(best_truth_idx, -1).scatter_reduce_(1, best_prior_idx, obj_idx, 'amax')
+    forced = forced_idx >= 0
+    best_truth_overlap.masked_fill_(forced, 1)
+    best_truth_idx = torch.where(forced, forced_idx, best_truth_idx)
+
+    overlap_t.copy_(best_truth_overlap)  # [batch,num_priors] jaccord for each prior
+    conf_t.copy_(labels.gather(1, best_truth_idx))  # [batch,num_priors] top class label for each prior
+    loc_t.copy_(truths.gather(1, best_truth_idx.unsqueeze(-1).expand(num, num_priors, 4)))  # Shape: [batch,num_priors,4]
+
+
 def mutual_match(truths, priors, regress, classif, labels, loc_t, conf_t, overlap_t, pred_t, idx):
     """Classify to regress and regress to classify, Mutual Match for label assignement.
     Args:
@@ -142,6 +173,66 @@ def mutual_match(truths, priors, regress, classif, labels, loc_t, conf_t, overla
     loc_t[idx] = truths[best_truth_idx]  # Shape: [num_priors,4]
 
 
+def mutual_match_batch(truths, priors, regress, classif, labels, valid, loc_t, conf_t, overlap_t, pred_t):
+    """Batched version of mutual_match, label assignement for the whole mini-batch
+    in one vectorized pass. Images with fewer objects are padded up to max_obj,
+    the padded rows are masked out by valid and never selected.
+    Args:
+        truths: (tensor) Padded ground truth boxes, Shape: [batch, max_obj, 4].
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [num_priors, 4].
+        regress: (tensor) Regression prediction, Shape: [batch, num_priors, 4].
+        classif: (tensor) Classification prediction, Shape: [batch, num_priors, num_classes].
+        labels: (tensor) Padded class labels, Shape: [batch, max_obj].
+        valid: (tensor) Mask of the non-padded objects, Shape: [batch, max_obj].
+        loc_t: (tensor) Tensor to be filled w/ endcoded location targets.
+        conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds.
+        overlap_t: (tensor) Tensor to be filled w/ iou score for each priors.
+        pred_t: (tensor) Tensor to be filled w/ pred score for each priors.
+    """
+
+    (num, num_obj) = labels.size()
+    num_priors = priors.size(0)
+    invalid = ~valid.unsqueeze(-1)
+    acr_overlaps = jaccard(truths, point_form(priors))  # [batch,max_obj,num_priors]
+    reg_overlaps = jaccard(truths, decode(regress, priors))
+    classif = classif.sigmoid().transpose(1, 2)
+    cls_idx = ((labels - 1) % classif.size(1)).unsqueeze(-1).expand(num, num_obj, num_priors)
+    pred_classifs = classif.gather(1, cls_idx)
+    sigma = 2.0
+    pred_classifs = acr_overlaps ** ((sigma - pred_classifs) / sigma)
+    for overlaps in (acr_overlaps, reg_overlaps, pred_classifs):
+        overlaps.scatter_(2, overlaps.max(2, keepdim=True)[1], 1.0)
+        overlaps.masked_fill_(invalid, -1.0)
+        overlaps[overlaps != overlaps.max(dim=1, keepdim=True)[0]] = 0.0
+        overlaps.masked_fill_(invalid, -1.0)
+
+    # per object top-k, ranks are shared by all the objects of the batch
+    num_ign = (acr_overlaps >= 0.4).sum(2, keepdim=True)
+    num_pos = (acr_overlaps >= 0.5).sum(2, keepdim=True)
+    max_ign = int(num_ign.max())
+    rank = torch.arange(max_ign, device=truths.device)
+
+    top_idx = torch.topk(reg_overlaps, max_ign, dim=2, largest=True)[1]
+    top_val = reg_overlaps.gather(2, top_idx)
+    top_val = torch.where(rank < num_ign, torch.full_like(top_val, 2.0), top_val)
+    top_val = torch.where(rank < num_pos, torch.full_like(top_val, 3.0), top_val)
+    reg_overlaps.scatter_(2, top_idx, top_val)
+
+    top_idx = torch.topk(pred_classifs, max_ign, dim=2, largest=True)[1]
+    top_val = pred_classifs.gather(2, top_idx)
+    top_val = torch.where(rank < num_pos, torch.full_like(top_val, 3.0), top_val)
+    pred_classifs.scatter_(2, top_idx, top_val)
+
+    ## for classification ###
+    (best_truth_overlap, best_truth_idx) = reg_overlaps.max(dim=1)
+    overlap_t.copy_(best_truth_overlap)  # [batch,num_priors] jaccord for each prior
+    conf_t.copy_(labels.gather(1, best_truth_idx))  # [batch,num_priors] top class label for each prior
+    ## for regression ###
+    (best_truth_overlap, best_truth_idx) = pred_classifs.max(dim=1)
+    pred_t.copy_(best_truth_overlap)  # [batch,num_priors] jaccord for each prior
+    loc_t.copy_(truths.gather(1, best_truth_idx.unsqueeze(-1).expand(num, num_priors, 4)))  # Shape: [batch,num_priors,4]
+
+
 def encode(matched, priors, variances=[0.1, 0.2]):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -168,7 +259,7 @@ def decode(loc, priors, variances=[0.1, 0.2]):
     the encoding we did for offset regression at train time.
     Args:
         loc (tensor): location predictions for loc layers,
-            Shape: [num_priors,4]
+            Shape: [num_priors,4] or [batch,num_priors,4]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
@@ -176,10 +267,10 @@ def decode(loc, priors, variances=[0.1, 0.2]):
         decoded bounding box predictions
     """
 
-    boxes = torch.cat((priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:], 
-                       priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
+    boxes = torch.cat((priors[:, :2] + loc[..., :2] * variances[0] * priors[:, 2:], 
+                       priors[:, 2:] * torch.exp(loc[..., 2:] * variances[1])), -1)
+    boxes[..., :2] -= boxes[..., 2:] / 2
+    boxes[..., 2:] += boxes[..., :2]
     return boxes
 
 
@@ -232,3 +323,94 @@ def nms(dets, thresh=0.5):
 
     return keep
 
+
+def nms_matrix(dets, thresh=0.5, block_size=64):
+    """Non maximun suppression on a pairwise iou matrix, keeps the same boxes
+    as nms(). Boxes are swept by blocks in score order: the iou of the
+    surviving boxes of a block against all lower scored boxes is computed at
+    once, the block is resolved on its own columns, then its kept boxes
+    suppress the following blocks in a single boolean reduction.
+    Args:
+        dets (numpy arrays): detected bounding boxes
+        thresh (float): iou threshold
+        block_size (int): number of boxes swept at once
+    """
+
+    order = dets[:, 4].argsort()[::-1]
+    (x1, y1, x2, y2) = (dets[order, 0], dets[order, 1], dets[order, 2], dets[order, 3])
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    num = order.size
+    suppressed = np.zeros(num, dtype=bool)
+    for start in range(0, num, block_size):
+        end = min(start + block_size, num)
+        cols = start + np.where(~suppressed[start:])[0]  # surviving boxes from this block on
+        rows = cols[cols < end]
+        if rows.size == 0:
+            continue
+        xx1 = np.maximum(x1[rows, np.newaxis], x1[np.newaxis, cols])
+        yy1 = np.maximum(y1[rows, np.newaxis], y1[np.newaxis, cols])
+        xx2 = np.minimum(x2[rows, np.newaxis], x2[np.newaxis, cols])
+        yy2 = np.minimum(y2[rows, np.newaxis], y2[np.newaxis, cols])
+
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[rows, np.newaxis] + areas[np.newaxis, cols] - inter)
+        over = ~(ovr <= thresh)
+
+        # resolve the block on its own columns, in score order
+        (n, alive) = (rows.size, np.ones(rows.size, dtype=bool))
+        for r in range(n):
+            if alive[r]:
+                alive[r + 1:] &= ~over[r, r + 1:n]
+        suppressed[rows[~alive]] = True
+        # then the kept boxes of the block suppress the following blocks
+        suppressed[cols[n:]] |= over[alive, n:].any(axis=0)
+
+    return list(order[~suppressed])
+
+def multiclass_nms(boxes, scores, score_thresh=0.005, iou_thresh=0.5, pre_nms_top_k=0, max_per_image=300):
+    """Class-aware Non maximun suppression for a batch of images, on the device
+    of the inputs. All the images and classes are suppressed in a single
+    batched_nms call, boxes of different (image, class) pairs never overlap.
+    Args:
+        boxes: (tensor) decoded boxes in image coordinates, Shape: [batch,num_priors,4]
+        scores: (tensor) class scores w/o background, Shape: [batch,num_priors,num_classes]
+        score_thresh: (float) minimal score of the candidates
+        iou_thresh: (float) iou threshold
+        pre_nms_top_k: (int) keep at most this many candidates per image before nms, 0 to keep all
+        max_per_image: (int) keep at most this many detections per image after nms, 0 to keep all
+    Return:
+        (list of tensors) detections of each image sorted by score,
+            Shape: [num_dets,6] as (xmin, ymin, xmax, ymax, score, class),
+            class starting from 1 as in the dataset labels (0 is background)
+    """
+
+    (num, num_priors, num_classes) = scores.size()
+    flat_scores = scores.reshape(num, -1)
+    if pre_nms_top_k > 0 and pre_nms_top_k < flat_scores.size(1):
+        (top_scores, top_idx) = flat_scores.topk(pre_nms_top_k, dim=1)
+        img_idx = torch.arange(num, device=scores.device).unsqueeze(1).expand_as(top_idx)
+        mask = top_scores > score_thresh
+        (img_idx, flat_idx, cand_scores) = (img_idx[mask], top_idx[mask], top_scores[mask])
+    else:
+        (img_idx, flat_idx) = (flat_scores > score_thresh).nonzero(as_tuple=True)
+        cand_scores = flat_scores[img_idx, flat_idx]
+    (prior_idx, cls_idx) = (flat_idx // num_classes, flat_idx % num_classes)
+    cand_boxes = boxes[img_idx, prior_idx]
+
+    # +1 on xmax/ymax so that the areas match the (x2 - x1 + 1) convention of nms()
+    nms_boxes = torch.cat((cand_boxes[:, :2], cand_boxes[:, 2:] + 1), 1)
+    keep = batched_nms(nms_boxes, cand_scores, img_idx * num_classes + cls_idx, iou_thresh)  # sorted by score
+
+    # group by image, keeping the score order, then cap each image
+    keep = keep[torch.sort(img_idx[keep], stable=True)[1]]
+    counts = torch.bincount(img_idx[keep], minlength=num)
+    if max_per_image > 0:
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.arange(keep.size(0), device=keep.device) - starts[img_idx[keep]]
+        keep = keep[rank < max_per_image]
+        counts = counts.clamp(max=max_per_image)
+    dets = torch.cat((cand_boxes[keep], cand_scores[keep].unsqueeze(1), (cls_idx[keep] + 1).unsqueeze(1).type_as(cand_scores)), 1)
+    return list(dets.split(counts.tolist()))
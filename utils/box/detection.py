@@ -23,19 +23,19 @@ class Detect(Function):
         """
         Args:
             loc_data: (tensor) Loc preds from loc layers
-                Shape: [batch,num_priors*4]
+                Shape: [batch,num_priors,4]
             conf_data: (tensor) Shape: Conf preds from conf layers
-                Shape: [batch*num_priors,num_classes]
+                Shape: [batch,num_priors,num_classes]
             prior_data: (tensor) Prior boxes and variances from priorbox layers
-                Shape: [1,num_priors,4]
+                Shape: [num_priors,4]
+        Return:
+            decoded boxes [batch,num_priors,4] and scores [batch,num_priors,num_classes]
         """
 
         (loc, conf) = predictions
         loc_data = loc.data
         conf_data = conf.data
         prior_data = prior.data
-        assert loc_data.size(0) == 1,  'Batch size = {} during evaluation'.format(loc_data.size(0))
-        decoded_boxes = decode(loc_data.squeeze(0), prior_data).clamp(min=0, max=1)
-        conf_scores = conf_data.squeeze(0).sigmoid()
+        decoded_boxes = decode(loc_data, prior_data).clamp(min=0, max=1)
+        conf_scores = conf_data.sigmoid()
         return (decoded_boxes, conf_scores)
-
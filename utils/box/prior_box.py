@@ -2,41 +2,62 @@
 # -*- coding: utf-8 -*-
 
 import torch
-import torch.nn as nn
-import torch.backends.cudnn as cudnn
 import math
 from math import sqrt as sqrt
-from itertools import product as product
+
+
+_priors_cache = {}
 
 
 class PriorBox(object):
 
-    """Predefined anchor boxes"""
+    """Predefined anchor boxes
+
+    Arguments:
+        base_anchor (float): anchor size of the first level, in pixels
+        image (int or tuple): input size, or (height, width) for non-square inputs
+        device (torch.device): device of the anchors
+        levels (int): number of feature levels, by default 4 below 512 pixels and 5 otherwise
+    """
 
-    def __init__(self, base_anchor, image):
+    def __init__(self, base_anchor, image, device=None, levels=None):
         super(PriorBox, self).__init__()
-        repeat = (4 if image < 512 else 5)
-        self.image = int(image)
+        (height, width) = (image if isinstance(image, (tuple, list)) else (image, image))
+        self.image = (int(height), int(width))
+        self.levels = (levels if levels is not None else (4 if max(self.image) < 512 else 5))
         self.base_anchor = base_anchor
-        self.feature_map = [math.ceil(self.image / 2 ** (3 + i)) for i in range(repeat)]
+        self.device = torch.device(device if device is not None else 'cpu')
+        self.feature_map = [(math.ceil(self.image[0] / 2 ** (3 + i)), math.ceil(self.image[1] / 2 ** (3 + i)))
+                            for i in range(self.levels)]
 
     def forward(self):
+        """Anchors as (cx, cy, w, h) rows, ordered by level, row, column and shape
+
+        The anchors are computed once per (base_anchor, image, levels, device)
+        and shared, they must not be modified in place.
+        """
+        key = (self.base_anchor, self.image, self.levels, self.device)
+        if key not in _priors_cache:
+            _priors_cache[key] = self._generate()
+        return _priors_cache[key]
+
+    def _generate(self):
         mean = []
-        for (k, (f_h, f_w)) in enumerate(zip(self.feature_map, self.feature_map)):
-            for (i, j) in product(range(f_h), range(f_w)):
-                cy = (i + 0.5) / f_h
-                cx = (j + 0.5) / f_w
-
-                anchor = self.base_anchor * 2 ** k / self.image
-                mean += [cx, cy, anchor, anchor]
-                mean += [cx, cy, anchor * sqrt(2), anchor / sqrt(2)]
-                mean += [cx, cy, anchor / sqrt(2), anchor * sqrt(2)]
-                anchor *= sqrt(2)
-                mean += [cx, cy, anchor, anchor]
-                mean += [cx, cy, anchor * sqrt(2), anchor / sqrt(2)]
-                mean += [cx, cy, anchor / sqrt(2), anchor * sqrt(2)]
-
-        output = torch.Tensor(mean).view(-1, 4)
+        (height, width) = self.image
+        for (k, (f_h, f_w)) in enumerate(self.feature_map):
+            (anchor_w, anchor_h) = (self.base_anchor * 2 ** k / width, self.base_anchor * 2 ** k / height)
+            sizes = []
+            for scale in (1, sqrt(2)):
+                (w, h) = (anchor_w * scale, anchor_h * scale)
+                sizes += [(w, h), (w * sqrt(2), h / sqrt(2)), (w / sqrt(2), h * sqrt(2))]
+            sizes = torch.tensor(sizes, dtype=torch.float64, device=self.device)
+
+            cy = (torch.arange(f_h, dtype=torch.float64, device=self.device) + 0.5) / f_h
+            cx = (torch.arange(f_w, dtype=torch.float64, device=self.device) + 0.5) / f_w
+            (cy, cx) = torch.meshgrid(cy, cx, indexing='ij')
+            centers = torch.stack((cx, cy), dim=-1).view(-1, 1, 2).expand(-1, len(sizes), 2)
+            mean.append(torch.cat((centers, sizes.expand_as(centers)), dim=-1).reshape(-1, 4))
+
+        output = torch.cat(mean, dim=0).float()
         output.clamp_(max=1, min=0)
         return output
-
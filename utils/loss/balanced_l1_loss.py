@@ -24,7 +24,7 @@ class BalancedL1Loss(nn.Module):
         target,
         reduction='mean',
         ):
-        diff = torch.abs(pred - target)
+        diff = torch.abs(pred.float() - target.float())
         b = np.e ** (self.gamma / self.alpha) - 1
         smbloss = torch.where(diff < self.beta, self.alpha / b * (b
                               * diff + 1) * torch.log(b * diff
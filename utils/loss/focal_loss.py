@@ -17,6 +17,7 @@ class FocalLoss(nn.Module):
         target,
         reduction='sum',
         ):
+        pred = pred.float()
         pred_sigmoid = pred.sigmoid()
         target = target.type_as(pred)
         pt = (1 - pred_sigmoid) * target + pred_sigmoid * (1 - target)
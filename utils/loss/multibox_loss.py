@@ -4,7 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from ..box import match, mutual_match, encode, decode
+from torch.nn.utils.rnn import pad_sequence
+from ..box import match_batch, mutual_match_batch, encode, decode
 from .balanced_l1_loss import BalancedL1Loss
 from .focal_loss import FocalLoss
 
@@ -18,26 +19,42 @@ class MultiBoxLoss(nn.Module):
         self.focal_loss = FocalLoss(alpha=0.25, gamma=1.0)
         self.reg_loss = BalancedL1Loss(alpha=0.5, gamma=1.5, beta=0.11)
 
-    def forward(self, predictions, priors, targets):
+    def forward(self, predictions, priors, targets, valid=None):
+        """
+        Args:
+            predictions: (tuple) loc preds [batch,num_priors,4] and conf preds [batch,num_priors,num_classes]
+            priors: (tensor) Prior boxes, Shape: [num_priors,4]
+            targets: (list of tensors) annotations of each image [num_obj,5],
+                or (tensor) padded annotations [batch,max_obj,5] from detection_collate(packed=True)
+            valid: (tensor) mask of the non-padded annotations [batch,max_obj], for padded targets only
+        """
         (loc_data, conf_data) = predictions
+        (loc_data, conf_data) = (loc_data.float(), conf_data.float())  # matching and losses in fp32 under amp
         num = loc_data.size(0)  # loc_data should be (batch_size,num_priors,4)
         num_priors = priors.size(0)  # priors should be (num_priors,4)
+        device = loc_data.device
+
+        if torch.is_tensor(targets):
+            packed = targets.data
+            if valid is None:
+                valid = torch.ones(packed.size()[:2], dtype=torch.bool, device=packed.device)
+        else:
+            # pad the per-image targets to [batch,max_obj,5]
+            packed = pad_sequence([anno.data for anno in targets], batch_first=True)
+            num_obj = torch.LongTensor([anno.size(0) for anno in targets]).to(packed.device)
+            valid = torch.arange(packed.size(1), device=packed.device).unsqueeze(0) < num_obj.unsqueeze(1)
+        truths = packed[:, :, :-1]
+        labels = packed[:, :, -1].long()
 
         if self.mutual_guide:
 
             # match priors (default boxes) and ground truth boxes
-            loc_t = torch.zeros(num, num_priors, 4).cuda()
-            conf_t = torch.LongTensor(num, num_priors).cuda()
-            overlap_t = torch.zeros(num, num_priors).cuda()
-            pred_t = torch.zeros(num, num_priors).cuda()
+            loc_t = torch.zeros(num, num_priors, 4, device=device)
+            conf_t = torch.zeros(num, num_priors, dtype=torch.long, device=device)
+            overlap_t = torch.zeros(num, num_priors, device=device)
+            pred_t = torch.zeros(num, num_priors, device=device)
             defaults = priors.data
-            for idx in range(num):
-                truths = targets[idx][:, :-1].data
-                labels = targets[idx][:, -1].data
-                labels = labels.long()
-                regress = loc_data[idx, :, :].data
-                classif = conf_data[idx, :, :].data
-                mutual_match(truths, defaults, regress, classif, labels, loc_t, conf_t, overlap_t, pred_t, idx)
+            mutual_match_batch(truths, defaults, loc_data.data, conf_data.data, labels, valid, loc_t, conf_t, overlap_t, pred_t)
             loc_t = Variable(loc_t, requires_grad=False)
             conf_t = Variable(conf_t, requires_grad=False)
             overlap_t = Variable(overlap_t, requires_grad=False)
@@ -62,7 +79,7 @@ class MultiBoxLoss(nn.Module):
             pos_cls_num = max(pos.data.float().sum(), 1)
             conf_t[(ign + neg).gt(0)] = 0
             with torch.no_grad():
-                conf_label = torch.FloatTensor(num * num_priors, self.num_classes + 1).cuda().zero_()
+                conf_label = torch.zeros(num * num_priors, self.num_classes + 1, device=device)
                 conf_label.scatter_(1, conf_t.view(-1, 1), 1)
                 conf_label = conf_label[:, 1:]
             pos_idx = (pos + neg).gt(0).unsqueeze(-1).expand_as(conf_data)
@@ -75,16 +92,11 @@ class MultiBoxLoss(nn.Module):
         else:
 
             # match priors (default boxes) and ground truth boxes
-            overlap_t = torch.Tensor(num, num_priors).cuda()
-            loc_t = torch.Tensor(num, num_priors, 4).cuda()
-            conf_t = torch.LongTensor(num, num_priors).cuda()
+            overlap_t = torch.zeros(num, num_priors, device=device)
+            loc_t = torch.zeros(num, num_priors, 4, device=device)
+            conf_t = torch.zeros(num, num_priors, dtype=torch.long, device=device)
             defaults = priors.data
-            obj_num = 0
-            for idx in range(num):
-                truths = targets[idx][:, :-1].data
-                labels = targets[idx][:, -1].data
-                match(truths, defaults, labels, loc_t, conf_t, overlap_t, idx)
-                obj_num += len(labels)
+            match_batch(truths, defaults, labels, valid, loc_t, conf_t, overlap_t)
             overlap_t = Variable(overlap_t, requires_grad=False)
             loc_t = Variable(loc_t, requires_grad=False)
             conf_t = Variable(conf_t, requires_grad=False)
@@ -109,7 +121,7 @@ class MultiBoxLoss(nn.Module):
             posneg_idx = (pos + neg).gt(0).unsqueeze(-1).expand_as(conf_data)
             conf_data = conf_data[posneg_idx].view(-1, self.num_classes)
             with torch.no_grad():
-                batch_label = torch.FloatTensor(num * num_priors, self.num_classes + 1).cuda().zero_()
+                batch_label = torch.zeros(num * num_priors, self.num_classes + 1, device=device)
                 batch_label.scatter_(1, conf_t.view(-1, 1), 1)
                 batch_label = batch_label[:, 1:][posneg_idx.view(-1, self.num_classes)].view(-1, self.num_classes)
             loss_c = self.focal_loss(conf_data, batch_label, reduction='sum')